@@ -0,0 +1,197 @@
+import argparse
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from pledger import Transaction, balance, parse_file, register, report
+
+
+def get_leaf_accounts(top, depth, fan_out):
+    return [":".join([top] + [f"C{i}" for i in path]) for path in itertools.product(range(fan_out), repeat=depth - 1)]
+
+
+def generate_ledger(num_transactions, seed=0, depth=3, fan_out=4, commodities=2, auto_rules=2, periodic_rules=2, interest_rules=1, assertion_every=50, per_day=10):
+    rng = random.Random(seed)
+    expenses = get_leaf_accounts("Expenses", depth, fan_out)
+    incomes = get_leaf_accounts("Income", depth, fan_out)
+    # commodity names can't contain digits
+    stocks = ["STK" + "".join(chr(ord("A") + int(d)) for d in str(i)) for i in range(commodities)]
+    start = datetime.date(2000, 1, 1)
+
+    lines = ["2000/01/01 * Opening Balance", "    Assets:Bank    $1000", "    Equity", ""]
+    for k in range(interest_rules):
+        lines += [f"2000/01/01 Loan {k}", f"    Loan:L{k}    $10000", "    Assets:Bank", ""]
+        lines += [f"I Loan:L{k} ~monthly -(.06 / 12) Income:Interest :Interest", ""]
+    for k in range(auto_rules):
+        lines += [f"= ^{expenses[k % len(expenses)]}", f"    Assets:Rewards:R{k}    .01", f"    Income:Rewards:R{k}    -.01", ""]
+    for k in range(periodic_rules):
+        lines += [f"~{('monthly', 'yearly')[k % 2]}", f"    Expenses:Subscription:S{k}    $9.99", "    Assets:Bank", ""]
+
+    checked = 0
+    for i in range(num_transactions):
+        date = start + datetime.timedelta(days=i // per_day)
+        lines.append(f"{date:%Y/%m/%d} Transaction {i}")
+        kind = rng.random()
+        if assertion_every and i % assertion_every == assertion_every - 1:
+            # only the generator posts to Assets:Checked, so it can keep the asserted balance
+            cents = rng.randint(-5000, 5000)
+            checked += cents
+            lines.append(f"    Assets:Checked    ${cents / 100:.2f} =${checked / 100:.2f}")
+        elif stocks and kind < 0.2:
+            price = f"@ ${rng.randint(100, 5000) / 100:.2f}" if kind < 0.1 else f"@@ ${rng.randint(100, 50000) / 100:.2f}"
+            lines.append(f"    Assets:Broker:{rng.choice(stocks)}    {rng.randint(1, 20)} {rng.choice(stocks)} {price}")
+        elif interest_rules and kind < 0.25:
+            lines.append(f"    Loan:L{rng.randrange(interest_rules)}:Payment    -$100")
+        elif kind < 0.35:
+            lines.append(f"    {rng.choice(incomes)}    -${rng.randint(100, 300000) / 100:.2f}")
+        else:
+            lines.append(f"    {rng.choice(expenses)}    ${rng.randint(1, 20000) / 100:.2f}")
+        lines.append("    Assets:Bank")
+        lines.append("")
+    return lines
+
+
+@contextlib.contextmanager
+def time_method(cls, name, elapsed):
+    method = getattr(cls, name)
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            elapsed[0] += time.perf_counter() - start
+    setattr(cls, name, timed)
+    try:
+        yield elapsed
+    finally:
+        setattr(cls, name, method)
+
+
+def run_phases(lines, phase):
+    commit_time = [0]
+    with phase("parse"), time_method(Transaction, "commit", commit_time):
+        root, transactions = parse_file(lines)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        with phase("balance"):
+            balance(root, transactions)
+        with phase("register"):
+            register(root, transactions)
+        with phase("report"):
+            report(root, transactions, date_index=1)
+    return transactions, commit_time[0]
+
+
+def benchmark(lines):
+    results = {}
+
+    @contextlib.contextmanager
+    def timer(name):
+        start = time.perf_counter()
+        yield
+        results[name] = {"seconds": time.perf_counter() - start}
+
+    transactions, commit_time = run_phases(lines, timer)
+    results["commit"] = {"seconds": commit_time}
+
+    # tracemalloc slows everything down, so memory gets its own pass
+    @contextlib.contextmanager
+    def tracer(name):
+        # only count what the phase allocates on top of what is already live
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        yield
+        results[name]["peak_bytes"] = tracemalloc.get_traced_memory()[1] - current
+
+    tracemalloc.start()
+    try:
+        traced_transactions = run_phases(lines, tracer)[0]
+        # what the parsed ledger keeps alive once the phases are done
+        retained = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    postings = sum(len(t.items) for t in transactions)
+    for phase in results.values():
+        phase["us_per_posting"] = phase["seconds"] / postings * 1e6
+        if "peak_bytes" in phase:
+            phase["peak_bytes_per_posting"] = phase["peak_bytes"] / postings
+    return {"postings": postings, "retained_bytes_per_posting": retained / postings, "phases": results}
+
+
+def compare(results, baseline, threshold, min_seconds=0.01, min_bytes=1 << 20):
+    regressions = []
+    for size, result in results.items():
+        if size not in baseline:
+            continue
+        old = baseline[size].get("retained_bytes_per_posting")
+        if old:
+            ratio = result["retained_bytes_per_posting"] / old
+            print(f"{size:>8} {'retained':10s} {'bytes_per_posting':24s} {old:12.1f} -> {result['retained_bytes_per_posting']:12.1f} ({ratio:.2f}x)")
+            if ratio > threshold:
+                regressions.append((size, "retained", "bytes_per_posting", ratio))
+        for name, phase in result["phases"].items():
+            old = baseline[size]["phases"].get(name)
+            if not old:
+                continue
+            for metric in ("us_per_posting", "peak_bytes_per_posting"):
+                # phases that take a few milliseconds or allocate next to nothing are mostly noise
+                if metric == "us_per_posting" and old["seconds"] < min_seconds:
+                    continue
+                if metric == "peak_bytes_per_posting" and old.get("peak_bytes", 0) < min_bytes:
+                    continue
+                if metric in phase and old.get(metric):
+                    ratio = phase[metric] / old[metric]
+                    print(f"{size:>8} {name:10s} {metric:24s} {old[metric]:12.1f} -> {phase[metric]:12.1f} ({ratio:.2f}x)")
+                    if ratio > threshold:
+                        regressions.append((size, name, metric, ratio))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Time parsing and reporting on synthetic ledgers")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="Numbers of transactions to generate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--depth", type=int, default=3, help="Depth of the Expenses/Income account trees")
+    parser.add_argument("--fan-out", type=int, default=4, help="Children per account in the Expenses/Income trees")
+    parser.add_argument("--commodities", type=int, default=2, help="Commodities bought with @/@@ prices")
+    parser.add_argument("--auto-rules", type=int, default=2, help="Number of = rules")
+    parser.add_argument("--periodic-rules", type=int, default=2, help="Number of ~ rules")
+    parser.add_argument("--interest-rules", type=int, default=1, help="Number of I rules")
+    parser.add_argument("--assertion-every", type=int, default=50, help="Add a balance assertion every N transactions; 0 disables them")
+    parser.add_argument("--save", metavar="FILE", help="Write the results to FILE as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="Compare against the results saved in FILE")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Slowdown (or memory growth) ratio that counts as a regression")
+    namespace = parser.parse_args(args)
+
+    results = {}
+    for size in namespace.sizes:
+        lines = generate_ledger(size, seed=namespace.seed, depth=namespace.depth, fan_out=namespace.fan_out, commodities=namespace.commodities,
+                                auto_rules=namespace.auto_rules, periodic_rules=namespace.periodic_rules, interest_rules=namespace.interest_rules,
+                                assertion_every=namespace.assertion_every)
+        result = results[str(size)] = benchmark(lines)
+        print(f"{size} transactions, {result['postings']} postings, {result['retained_bytes_per_posting']:.0f} bytes/posting retained")
+        for name, phase in result["phases"].items():
+            peak = f"{phase['peak_bytes_per_posting']:10.0f} peak bytes/posting" if "peak_bytes_per_posting" in phase else ""
+            print(f"    {name:10s} {phase['seconds']:8.3f}s {phase['us_per_posting']:10.2f} us/posting {peak}")
+
+    if namespace.save:
+        with open(namespace.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if namespace.compare:
+        with open(namespace.compare) as f:
+            regressions = compare(results, json.load(f), namespace.threshold)
+        for size, name, metric, ratio in regressions:
+            print(f"Regression: {name} {metric} at {size} transactions is {ratio:.2f}x the baseline", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
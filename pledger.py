@@ -1,13 +1,38 @@
 #!/bin/python3
 import argparse
+import asyncio
+import contextlib
+import concurrent.futures
 import datetime
+import gc
+import glob
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import logging
+import mmap
 import os
+import pickle
 import re
-from collections import defaultdict
-from decimal import Decimal
+import signal
+import socket
+import sys
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+from stat import S_ISREG, S_ISSOCK
 from string import whitespace
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 currency_regex = re.compile("[^\d\.\-\(\)\*\+\-/ ]+")
 
 
@@ -16,23 +41,323 @@ def getCurrencySymbol(token):
     return match.group(0) if(match) else ""
 
 
+# Restricted replacement for eval() on amounts: decimal numbers, + - * / and parentheses
+def evaluate(expr):
+    expr = expr.replace(" ", "")
+    pos = 0
+
+    def parse_expr():
+        nonlocal pos
+        value = parse_term()
+        while pos < len(expr) and expr[pos] in "+-":
+            op = expr[pos]
+            pos += 1
+            value = value + parse_term() if op == "+" else value - parse_term()
+        return value
+
+    def parse_term():
+        nonlocal pos
+        value = parse_factor()
+        while pos < len(expr) and expr[pos] in "*/":
+            op = expr[pos]
+            pos += 1
+            value = value * parse_factor() if op == "*" else value / parse_factor()
+        return value
+
+    def parse_factor():
+        nonlocal pos
+        if pos < len(expr) and expr[pos] in "+-":
+            op = expr[pos]
+            pos += 1
+            return parse_factor() if op == "+" else -parse_factor()
+        if pos < len(expr) and expr[pos] == "(":
+            pos += 1
+            value = parse_expr()
+            if pos >= len(expr) or expr[pos] != ")":
+                raise ValueError("Unbalanced parentheses in '{}'".format(expr))
+            pos += 1
+            return value
+        start = pos
+        while pos < len(expr) and (expr[pos].isdigit() or expr[pos] == "."):
+            pos += 1
+        if start == pos:
+            raise ValueError("Expected number at position {} of '{}'".format(pos, expr))
+        return Decimal(expr[start:pos])
+
+    value = parse_expr()
+    if pos != len(expr):
+        raise ValueError("Unexpected '{}' in '{}'".format(expr[pos], expr))
+    return value
+
+
+def parse_quantity(commodity, expr):
+    if not expr.strip():
+        return None
+    try:
+        return commodity, Decimal(expr)
+    except InvalidOperation:
+        return commodity, evaluate(expr)
+
+
+# Splits a token like "10 STOCK @ $5 = 20 STOCK" in one scan into (amount, price, assertion);
+# amount and assertion are (commodity, value) and price is (commodity, value, is_total)
+@lru_cache(maxsize=4096)
+def parse_amount(token):
+    segments = []
+    commodity, expr, commodity_done = [], [], False
+    i = 0
+    while i <= len(token):
+        char = token[i] if i < len(token) else None
+        if char is None or char in "@=":
+            separator = char
+            if char == "@" and token[i + 1:i + 2] == "@":
+                separator = "@@"
+                i += 1
+            segments.append((separator, parse_quantity("".join(commodity), "".join(expr))))
+            commodity, expr, commodity_done = [], [], False
+        elif char in "0123456789.-()*+/ ":
+            expr.append(char)
+            commodity_done = commodity_done or bool(commodity)
+        elif not commodity_done:
+            commodity.append(char)
+        i += 1
+
+    amount = price = assertion = None
+    previous = None
+    for separator, quantity in segments:
+        if previous is None:
+            amount = quantity
+        elif previous in ("@", "@@"):
+            price = quantity + (previous == "@@", )
+        else:
+            assertion = quantity
+        previous = separator
+    return amount, price, assertion
+
+
+class AccountFilter:
+
+    def __init__(self, filter_strs):
+        self.filter_strs = tuple(filter_strs)
+        # compiled one by one; joined into one alternation, inline flags and backreferences would break
+        self.patterns = [re.compile(filterStr) for filterStr in self.filter_strs]
+
+    def __repr__(self):
+        return "AccountFilter({})".format(self.filter_strs)
+
+    # equal filters share the per account match memo, which keeps it bounded in a long running daemon
+    def __eq__(self, other):
+        return isinstance(other, AccountFilter) and self.filter_strs == other.filter_strs
+
+    def __hash__(self):
+        return hash(self.filter_strs)
+
+    def matches(self, account):
+        name = account.getProperName()
+        return any(pattern.match(name) for pattern in self.patterns)
+
+
+class DecimalBackend:
+
+    def fromDecimal(self, currency, value):
+        return value
+
+    def fromDerived(self, currency, value):
+        return value
+
+    def toDecimal(self, currency, value):
+        return value
+
+    def scale(self, currency, value, factor):
+        return value * factor
+
+    def normalize(self, value):
+        return round(value, 12)
+
+    def isZero(self, value):
+        return abs(value) <= 1e-6
+
+
+class PrecisionTooLow(ValueError):
+
+    def __init__(self, currency, value, precision):
+        super().__init__("{} {} has more than {} decimal places; declare a higher precision for it".format(value, currency, precision))
+        self.currency = currency
+        self.digits = -value.normalize().as_tuple().exponent
+
+
+# Stores amounts of each commodity as integers scaled by 10**precision, where the precision is either
+# declared or inferred from the amounts written in that commodity. Inferred precisions keep derived_digits
+# more places than were written, so amounts derived from prices and percentage rules come out as they would
+# with Decimals. Unitless amounts, like the factors of automatic transactions, stay Decimals.
+class FixedPointBackend:
+
+    def __init__(self, precision=None, default_precision=2, derived_digits=6):
+        self.precision = dict(precision or {})
+        self.declared = set(self.precision)
+        self.default_precision = default_precision
+        self.derived_digits = derived_digits
+        self.scaled = {}
+
+    def getPrecision(self, currency, digits=0):
+        precision = self.precision.get(currency)
+        if precision is None:
+            precision = self.precision[currency] = max(self.default_precision, digits) + self.derived_digits
+        return precision
+
+    def fromDecimal(self, currency, value):
+        if not currency:
+            return value
+        scaled = self.scaled.get((currency, value))
+        if scaled is None:
+            if len(self.scaled) > 1 << 16:
+                self.scaled.clear()
+            scaled = self.scaled[currency, value] = self.toScaled(currency, value)
+        return scaled
+
+    def toScaled(self, currency, value):
+        precision = self.getPrecision(currency, -value.as_tuple().exponent)
+        scaled = value.scaleb(precision)
+        if scaled != scaled.to_integral_value():
+            if currency in self.declared:
+                raise ValueError("{} {} has more than {} decimal places; declare a higher precision for it".format(value, currency, precision))
+            # the parser rescales what it holds and tries again
+            raise PrecisionTooLow(currency, value, precision)
+        return int(scaled)
+
+    def rescale(self, currency, digits, accounts, items):
+        precision = max(self.default_precision, digits) + self.derived_digits
+        factor = 10 ** (precision - self.precision[currency])
+        self.precision[currency] = precision
+        self.scaled.clear()
+        for account in accounts:
+            for values in (account.values, account.totals):
+                if currency in values:
+                    values[currency] *= factor
+        for item in items:
+            item.rescale(currency, factor)
+
+    def fromDerived(self, currency, value):
+        if not currency:
+            return value
+        return int(value.scaleb(self.getPrecision(currency)).to_integral_value())
+
+    def toDecimal(self, currency, value):
+        if not currency:
+            return value
+        return Decimal(value).scaleb(-self.precision[currency])
+
+    def scale(self, currency, value, factor):
+        if not currency:
+            return value * factor
+        return int((value * factor).to_integral_value())
+
+    def normalize(self, value):
+        return value
+
+    def isZero(self, value):
+        return value == 0
+
+
+class MarketPrices:
+
+    def __init__(self):
+        self.series = {}
+        self.graph = defaultdict(set)
+        self.rates = {}
+
+    def add(self, commodity, target, price, date=None):
+        date = date or 0
+        dates, prices = self.series.setdefault((commodity, target), ([], []))
+        if not dates or dates[-1] <= date:
+            dates.append(date)
+            prices.append(price)
+        else:
+            i = bisect_right(dates, date)
+            dates.insert(i, date)
+            prices.insert(i, price)
+        self.graph[commodity].add(target)
+        self.graph[target].add(commodity)
+        self.rates.clear()
+
+    def get(self, commodity, target, date=None):
+        dates, prices = self.series[commodity, target]
+        if date is None:
+            return prices[-1]
+        # before the first known price, the earliest one is the best estimate there is
+        return prices[max(bisect_right(dates, date) - 1, 0)]
+
+    def getDirectRate(self, commodity, target, date=None):
+        if (commodity, target) in self.series:
+            return self.get(commodity, target, date)
+        return 1 / self.get(target, commodity, date)
+
+    def getRate(self, commodity, target, date=None):
+        if commodity == target:
+            return 1
+        rate = self.rates.get((commodity, target, date))
+        if rate is None:
+            # breadth first search so the conversion goes through as few intermediate commodities as possible
+            rates = {commodity: 1}
+            queue = [commodity]
+            for current in queue:
+                for neighbour in self.graph[current]:
+                    if neighbour not in rates:
+                        rates[neighbour] = rates[current] * self.getDirectRate(current, neighbour, date)
+                        queue.append(neighbour)
+                if target in rates:
+                    break
+            if target not in rates:
+                raise KeyError("No conversion from {} to {}".format(commodity, target))
+            rate = self.rates[commodity, target, date] = rates[target]
+        return rate
+
+    def load(self, f):
+        entries = defaultdict(list)
+        for line in f:
+            if line.startswith("P"):
+                _, date, commodity, value = line.split(";", 1)[0].split()
+                (target, price), _, _ = parse_amount(value)
+                entries[commodity, target].append((date_key(date), price))
+        for (commodity, target), series in entries.items():
+            series.extend(zip(*self.series.get((commodity, target), ([], []))))
+            series.sort(key=lambda x: x[0])
+            self.series[commodity, target] = ([date for date, _ in series], [price for _, price in series])
+            self.graph[commodity].add(target)
+            self.graph[target].add(commodity)
+        self.rates.clear()
+
+
 class Account:
+    __slots__ = ("children", "name", "parent", "values", "totals", "market", "matchCache", "root", "numeric", "properName", "accounts", "depth", "stats", "includes")
 
-    def __init__(self, name="", parent=None):
+    def __init__(self, name="", parent=None, numeric=None):
         self.children = {}
         self.name = name
         self.parent = parent
         self.values = {}
-        self.market = {}
+        self.totals = {}
+        self.matchCache = {}
         if parent:
             assert name
             self.parent.children[name] = self
+            self.root = parent.root
+            self.numeric = parent.numeric
+            self.properName = parent.properName + ":" + name if parent.properName else name
+            self.root.accounts[self.properName] = self
+        else:
+            self.root = self
+            self.numeric = numeric or DecimalBackend()
+            self.properName = name
+            self.accounts = {}
+            self.market = MarketPrices()
+            self.stats = None
+            # abspath -> get_file_key of every included file, so caches can tell when one changed
+            self.includes = {}
+        self.depth = self.properName.count(":")
 
     def getProperName(self):
-        parentName = self.parent.getProperName() if self.parent else ""
-        if parentName:
-            parentName += ":"
-        return parentName + self.name
+        return self.properName
 
     def getAncestor(self, depth):
         return self if self.filterByDepth(depth) else self.parent.getAncestor(depth)
@@ -44,22 +369,25 @@ class Account:
         return str(self)
 
     def getRoot(self):
-        return self if self.parent == None else self.parent.getRoot()
+        return self.root
 
     def getDepth(self):
-        return self.getProperName().count(":")
+        return self.depth
 
     def filterByDepth(self, depth):
-        return depth is None or self.getDepth() < depth
+        return depth is None or self.depth < depth
 
     @staticmethod
     def isHidden(name):
         return name.startswith(".")
 
     def getAccount(self, name):
-        parent = self
         if name[0] in (":", "."):
             name = name[1:]
+        account = self.root.accounts.get(self.properName + ":" + name if self.properName else name)
+        if account:
+            return account
+        parent = self
         for component in name.split(":"):
             if component not in parent.children.keys():
                 parent.children[component] = Account(component, parent)
@@ -70,107 +398,138 @@ class Account:
 
     def addValue(self, currency, value, init=False):
         if value:
-            assert isinstance(value, Decimal)
+            assert isinstance(value, (Decimal, int))
             if init:
+                delta = value - self.values.get(currency, 0)
                 self.values[currency] = value
             else:
+                delta = value
                 self.values[currency] = self.values.get(currency, 0) + value
+            account = self
+            while account:
+                account.totals[currency] = account.totals.get(currency, 0) + delta
+                account = account.parent
 
-    def setMarketPrice(self, currency, c, value):
-        self.market[currency] = value
-
-    def getMarketPrice(self, currency, target):
-        return 1 if currency == target else self.market[currency]
+    def setMarketPrice(self, currency, c, value, date=None):
+        self.market.add(currency, c, value, date)
 
-    def __getValue(self, currency):
-        return self.values.get(currency, 0) + sum([children.__getValue(currency) for children in self.children.values()])
+    def getMarketPrice(self, currency, target, date=None):
+        return self.market.getRate(currency, target, date)
 
     def getSpecificValue(self, currency):
         return self.values.get(currency, 0)
 
     def getValue(self, currency):
-        return round(self.__getValue(currency), 12)
+        stats = self.root.stats
+        if stats is not None:
+            stats.count("getValue")
+        return self.numeric.normalize(self.totals.get(currency, 0))
 
     def getCurrencies(self):
-        return set(self.values.keys()).union(*[children.getCurrencies() for children in self.children.values()])
+        return self.totals.keys()
 
-    def matches(self, filter_strs):
-        if not filter_strs:
+    def matches(self, accountFilter):
+        if not accountFilter:
             return True
-        for filterStr in filter_strs:
-            if re.match(filterStr, self.getProperName()):
-                return True
+        if not isinstance(accountFilter, AccountFilter):
+            return AccountFilter(accountFilter).matches(self)
+        result = self.matchCache.get(accountFilter)
+        if result is None:
+            result = self.matchCache[accountFilter] = accountFilter.matches(self)
+        return result
 
 
 class TransactionItem:
-    def __init__(self, account, token=None, line_num=None, hidden=False):
+    # Almost all postings have a single commodity, so it is kept in currency/value and
+    # values only becomes a dict once a price conversion adds a second one
+    __slots__ = ("account", "currency", "value", "values", "finalValue", "line_num", "hidden")
+
+    def __init__(self, account, token=None, line_num=None, hidden=False, date=None, amounts=None):
         self.account = account
-        self.values = {}
+        self.currency = self.value = self.values = None
         self.finalValue = None
         self.line_num = line_num
-        self.__parse(token)
+        self.__parse(token, date, amounts)
 
         self.hidden = hidden
 
     def __str__(self):
-        return "#{} {} {}".format(self.line_num, self.account.getProperName(), self.values)
+        return "#{} {} {}".format(self.line_num, self.account.getProperName(), self.getValues())
 
-    def __parse(self, token):
+    def __parse(self, token, date=None, amounts=None):
         if token:
             if isinstance(token, tuple):
                 self.setValue(token[0], token[1])
-            elif "@@" in token:
-                parts = token.split("@@")
-                value = Decimal(currency_regex.sub("", parts[0]))
-                total_value = Decimal(currency_regex.sub("", parts[1])) * -abs(value) / value
-                self.setValue(getCurrencySymbol(parts[0]), value)
-                self.setValue(getCurrencySymbol(parts[1]), total_value)
-
-                self.account.getRoot().setMarketPrice(getCurrencySymbol(parts[0]), getCurrencySymbol(parts[1]), -total_value / value)
-            elif "@" in token:
-                parts = token.split("@")
-                value = Decimal(currency_regex.sub("", parts[0]))
-                value_per_unit = Decimal(currency_regex.sub("", parts[1]))
-                self.setValue(getCurrencySymbol(parts[0]), value)
-                self.setValue(getCurrencySymbol(parts[1]), value * value_per_unit * -1)
-                self.account.getRoot().setMarketPrice(getCurrencySymbol(parts[0]), getCurrencySymbol(parts[1]), value_per_unit)
-            elif "=" in token:
-                parts = token.split("=")
-
-                self.finalValue = getCurrencySymbol(parts[1]), Decimal(currency_regex.sub("", parts[1]))
-                if parts[0]:
-                    self.__parse(parts[0])
-                else:
-                    self.computeValueIfMissing()
-            elif "(" in token:
-                self.setValue(getCurrencySymbol(token), eval(currency_regex.sub("", token)))
-            else:
-                self.setValue(getCurrencySymbol(token), currency_regex.sub("", token))
+                return
+            numeric = self.account.numeric
+            amount, price, assertion = amounts or parse_amount(token)
+            if assertion:
+                self.finalValue = assertion[0], numeric.fromDecimal(*assertion)
+            if amount:
+                currency, value = amount
+                self.setValue(currency, numeric.fromDecimal(currency, value))
+                if price:
+                    target, price_value, is_total = price
+                    if is_total:
+                        total_value = price_value * -abs(value) / value
+                        price_value = -total_value / value
+                    else:
+                        total_value = value * price_value * -1
+                    self.setValue(target, numeric.fromDerived(target, total_value))
+                    self.account.getRoot().setMarketPrice(currency, target, price_value, date)
+            elif assertion:
+                self.computeValueIfMissing()
 
     def isHidden(self):
         return self.hidden
 
     def getValue(self, currency):
+        if self.values is None:
+            return self.value if currency == self.currency else 0
         return self.values.get(currency, 0)
 
+    def getValues(self):
+        if self.values is None:
+            return {} if self.currency is None else {self.currency: self.value}
+        return self.values
+
     def setValue(self, currency, value):
-        assert currency not in self.values
-        self.values[currency] = Decimal(value)
+        value = value if isinstance(value, int) else Decimal(value)
+        if self.currency is None and self.values is None:
+            self.currency, self.value = currency, value
+        else:
+            assert currency not in self.getValues()
+            if self.values is None:
+                self.values = {self.currency: self.value}
+                self.currency = self.value = None
+            self.values[currency] = value
 
     def isMissingValue(self):
-        return not self.values
+        return self.currency is None and self.values is None
 
     def hasImplicitValue(self):
         return self.isMissingValue() and not self.finalValue
 
     def getCurrencies(self):
-        return self.values.keys() if not self.finalValue else [self.finalValue[0]]
+        if self.finalValue:
+            return [self.finalValue[0]]
+        if self.values is None:
+            return () if self.currency is None else (self.currency, )
+        return self.values.keys()
 
     def getSingleCurrency(self):
-        return list(self.values.keys())[0]
+        return self.currency if self.values is None else next(iter(self.values))
 
     def isNetZero(self):
-        return len(self.values.keys()) > 1
+        return self.values is not None
+
+    def rescale(self, currency, factor):
+        if self.currency == currency:
+            self.value *= factor
+        elif self.values is not None and currency in self.values:
+            self.values[currency] *= factor
+        if self.finalValue and self.finalValue[0] == currency:
+            self.finalValue = currency, self.finalValue[1] * factor
 
     def computeValueIfMissing(self):
         if self.isMissingValue() and self.finalValue:
@@ -180,11 +539,14 @@ class TransactionItem:
     def postVerify(self):
         if self.finalValue:
             c, value = self.finalValue
-            if abs(self.account.getValue(c) - value) > 1e-6:
-                raise ValueError("Expected Value {} instead of {} at {}".format(value, self.account.getValue(c), self.line_num))
+            numeric = self.account.numeric
+            if not numeric.isZero(self.account.getValue(c) - value):
+                raise ValueError("Expected Value {} instead of {} at {}".format(numeric.toDecimal(c, value), numeric.toDecimal(c, self.account.getValue(c)), self.line_num))
 
 
 class AutoTransaction:
+    __slots__ = ("pattern", "root", "items", "label")
+
     def __init__(self, pattern, root, label):
         self.pattern = re.compile(pattern)
         self.root = root
@@ -195,35 +557,101 @@ class AutoTransaction:
         account = self.root.getAccount(accountName)
         item = TransactionItem(account, token, **kwargs)
         assert len(item.getCurrencies()) == 1
-        item.currency = list(item.getCurrencies())[0]
         self.items.append((item, accountName))
         return item
 
+    def matchesAccount(self, account):
+        return self.pattern.match(account.getProperName())
+
     def matchesTransactionItem(self, item):
-        return self.pattern.match(item.account.getProperName())
+        return self.matchesAccount(item.account)
 
     def addToTransaction(self, transaction, refItem):
         assert not isinstance(transaction, AutoTransaction)
         refCurrency = refItem.getSingleCurrency()
         for item, accountName in self.items:
             c = item.getSingleCurrency()
-            value = item.getValue(c) if c else item.getValue(c) * refItem.getValue(refCurrency)
+            value = item.getValue(c) if c else self.root.numeric.scale(refCurrency, refItem.getValue(refCurrency), item.getValue(c))
             transaction.addItem(accountName if accountName[0] != ":" else refItem.account.getProperName() + accountName, (c or refCurrency, value), line_num=item.line_num)
 
 
+# Dates are ordered as yyyymmdd integers; missing components count as 0, so "2021" sorts before every day in 2021
+def date_key(date):
+    parts = list(map(int, date.split("/"))) + [0, 0]
+    return parts[0] * 10000 + parts[1] * 100 + parts[2]
+
+
+def literal_prefix(pattern):
+    if "|" in pattern:
+        return ""
+    prefix = []
+    for i, char in enumerate(pattern):
+        if i == 0 and char == "^":
+            continue
+        if char in ".^$*+?{}[]\\()":
+            if char in "*?{" and prefix:
+                prefix.pop()
+            break
+        prefix.append(char)
+    return "".join(prefix)
+
+
+class AutoTransactionIndex:
+
+    def __init__(self):
+        self.sequence = 0
+        self.buckets = defaultdict(list)
+        self.unbucketed = []
+        self.memo = {}
+
+    def add(self, auto_transaction):
+        prefix = literal_prefix(auto_transaction.pattern.pattern)
+        entry = (self.sequence, prefix, auto_transaction)
+        if ":" in prefix:
+            self.buckets[prefix.split(":")[0]].append(entry)
+        else:
+            self.unbucketed.append(entry)
+        self.sequence += 1
+        self.memo.clear()
+
+    def __iter__(self):
+        for entries in [self.unbucketed, *self.buckets.values()]:
+            for _, _, auto_transaction in entries:
+                yield auto_transaction
+
+    def remove(self, label):
+        matches = [(entry, entries) for entries in [self.unbucketed, *self.buckets.values()] for entry in entries if entry[2].label == label]
+        if matches:
+            entry, entries = min(matches, key=lambda x: x[0][0])
+            entries.remove(entry)
+            self.memo.clear()
+            return entry[2]
+
+    def match(self, account):
+        rules = self.memo.get(account)
+        if rules is None:
+            name = account.getProperName()
+            candidates = self.buckets.get(name.split(":")[0], []) + self.unbucketed
+            rules = self.memo[account] = [auto_transaction for _, prefix, auto_transaction in sorted(candidates, key=lambda x: x[0])
+                                          if name.startswith(prefix) and auto_transaction.matchesAccount(account)]
+        return rules
+
+
 class Transaction:
+    __slots__ = ("items", "inferred_item", "date", "dateKey", "title", "initialize", "root", "line_num")
 
-    def __init__(self, date, title, root, line_num=None):
+    def __init__(self, date, title, root, line_num=None, dateKey=None):
         self.items = []
         self.inferred_item = None
         self.date = date
+        self.dateKey = date_key(date) if dateKey is None else dateKey
         self.title = title.strip()
         self.initialize = self.title.startswith("*")
         self.root = root
         self.line_num = line_num
 
     def __lt__(self, other):
-        return self.date < other.date
+        return self.dateKey < other.dateKey
 
     def get_date_identifier(self, date_index):
         return "/".join(self.date.split("/")[:date_index + 1])
@@ -241,7 +669,7 @@ class Transaction:
 
     def addItem(self, accountName, token=None, **kwargs):
         account = self.root.getAccount(accountName)
-        item = TransactionItem(account, token, hidden=Account.isHidden(accountName), **kwargs)
+        item = TransactionItem(account, token, hidden=Account.isHidden(accountName), date=self.dateKey, **kwargs)
         self.items.append(item)
         if item.hasImplicitValue():
             assert self.inferred_item is None
@@ -259,8 +687,8 @@ class Transaction:
                 if self.inferred_item:
                     self.inferred_item.setValue(c, -s)
                     s = 0
-                if abs(s) > 1e-6:
-                    logging.error("Transaction doesn't balance %.02f '%s' %s", s, c, [item.getValue(c) for item in self.items])
+                if not self.root.numeric.isZero(s):
+                    logging.error("Transaction doesn't balance %.02f '%s' %s", self.root.numeric.toDecimal(c, s), c, [item.getValue(c) for item in self.items])
                     raise ValueError(f"Transaction doesn't balance at {self.line_num}")
 
             for item in self.items:
@@ -268,9 +696,175 @@ class Transaction:
                 item.postVerify()
 
 
-def print_balance(value, currency, name=None, depth=0):
+class DateIndex:
+
+    def __init__(self, transactions):
+        if any(b < a for a, b in zip(transactions, transactions[1:])):
+            transactions = sorted(transactions)
+        self.transactions = transactions
+        self.keys = [t.dateKey for t in transactions]
+
+    def range(self, start=None, end=None):
+        lo = bisect_left(self.keys, date_key(start)) if start else 0
+        hi = bisect_right(self.keys, date_key(end)) if end else len(self.keys)
+        return self.transactions[lo:hi]
+
+
+class QueryPlan:
+    # which transactions a query reads; the defaults keep everything. The account tree is always
+    # kept up to date since balance assertions check against it
+    def __init__(self, retain=True, startKey=None, accountFilter=None, ancestors=False):
+        self.retain = retain
+        self.startKey = startKey
+        self.accountFilter = accountFilter
+        # also keep postings to accounts beneath a matching one
+        self.ancestors = ancestors
+
+    def __repr__(self):
+        return "QueryPlan(retain={}, startKey={}, accountFilter={}, ancestors={})".format(self.retain, self.startKey, self.accountFilter, self.ancestors)
+
+    def matches(self, account):
+        if not self.ancestors:
+            return account.matches(self.accountFilter)
+        while account:
+            if account.matches(self.accountFilter):
+                return True
+            account = account.parent
+        return False
+
+    def keep(self, transaction):
+        if not self.retain or self.startKey is not None and transaction.dateKey < self.startKey:
+            return False
+        return not self.accountFilter or any(self.matches(item.account) for item in transaction.items)
+
+
+class PostingStore:
+
+    def __init__(self, precision=8):
+        self.precision = precision
+        self.dates = array("i")
+        self.transaction_ids = array("i")
+        self.account_ids = array("i")
+        self.commodity_ids = array("i")
+        self.amounts = array("q")
+        self.transactions = []
+        self.accounts = []
+        self.account_index = {}
+        self.commodities = []
+        self.commodity_index = {}
+        self.sorted = True
+        self.largest = 0
+
+    def __len__(self):
+        return len(self.amounts)
+
+    # numpy sums in int64, which silently wraps around
+    def fitsInt64(self):
+        return isinstance(self.amounts, array) and self.largest * len(self) < 1 << 63
+
+    def internAccount(self, account):
+        account_id = self.account_index.get(account)
+        if account_id is None:
+            account_id = self.account_index[account] = len(self.accounts)
+            self.accounts.append(account)
+        return account_id
+
+    def internCommodity(self, commodity):
+        commodity_id = self.commodity_index.get(commodity)
+        if commodity_id is None:
+            commodity_id = self.commodity_index[commodity] = len(self.commodities)
+            self.commodities.append(commodity)
+        return commodity_id
+
+    def toScaled(self, value):
+        return int(Decimal(value).scaleb(self.precision).to_integral_value())
+
+    def toDecimal(self, value):
+        return Decimal(int(value)).scaleb(-self.precision)
+
+    def extend(self, transactions):
+        scaled = {}
+        for transaction in transactions:
+            transaction_id = len(self.transactions)
+            self.transactions.append(transaction)
+            key = transaction.dateKey
+            self.sorted = self.sorted and (not self.dates or self.dates[-1] <= key)
+            for item in transaction.items:
+                account_id = self.account_index.get(item.account)
+                if account_id is None:
+                    account_id = self.internAccount(item.account)
+                for c in item.getCurrencies():
+                    value = item.account.numeric.toDecimal(c, item.getValue(c))
+                    amount = scaled.get(value)
+                    if amount is None:
+                        amount = scaled[value] = self.toScaled(value)
+                        self.largest = max(self.largest, abs(amount))
+                    self.dates.append(key)
+                    self.transaction_ids.append(transaction_id)
+                    self.account_ids.append(account_id)
+                    self.commodity_ids.append(self.internCommodity(c))
+                    try:
+                        self.amounts.append(amount)
+                    except OverflowError:
+                        # past about 9.2e10 at the default precision; Python ints don't overflow
+                        self.amounts = list(self.amounts)
+                        self.amounts.append(amount)
+        return self
+
+    @staticmethod
+    def getPeriodLabel(bucket, date_index):
+        if date_index == 0:
+            return str(bucket)
+        if date_index == 1:
+            return f"{bucket // 100}/{bucket % 100:02d}"
+        return f"{bucket // 10000}/{bucket // 100 % 100:02d}/{bucket % 100:02d}"
+
+    def getRowRange(self, start=None, end=None):
+        if not self.sorted:
+            return 0, len(self)
+        lo = bisect_left(self.dates, date_key(start)) if start else 0
+        hi = bisect_right(self.dates, date_key(end)) if end else len(self)
+        return lo, hi
+
+    def groupByPeriod(self, accountFilter=None, date_index=1, start=None, end=None):
+        divisor = (10000, 100, 1)[date_index]
+        mask = [account.matches(accountFilter) for account in self.accounts]
+        lo, hi = self.getRowRange(start, end)
+        start_key = date_key(start) if start else 0
+        end_key = date_key(end) if end else sys.maxsize
+        if numpy and len(self) and self.fitsInt64():
+            columns = {name: column[lo:hi] for name, column in self.columns().items()}
+            selected = numpy.array(mask, dtype=bool)[columns["account_ids"]]
+            if not self.sorted:
+                selected &= (columns["dates"] >= start_key) & (columns["dates"] <= end_key)
+            keys = columns["dates"][selected].astype(numpy.int64) // divisor * len(self.commodities) + columns["commodity_ids"][selected]
+            unique_keys, first_index, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+            sums = numpy.zeros(len(unique_keys), dtype=numpy.int64)
+            numpy.add.at(sums, inverse, columns["amounts"][selected])
+            order = numpy.argsort(first_index, kind="stable")
+            sums = {divmod(int(unique_keys[i]), len(self.commodities)): sums[i] for i in order}
+        else:
+            sums = {}
+            for i in range(lo, hi):
+                d = self.dates[i]
+                if mask[self.account_ids[i]] and start_key <= d <= end_key:
+                    key = (d // divisor, self.commodity_ids[i])
+                    sums[key] = sums.get(key, 0) + self.amounts[i]
+        return {(self.getPeriodLabel(bucket, date_index), self.commodities[commodity_id]): self.toDecimal(value) for (bucket, commodity_id), value in sums.items()}
+
+    def columns(self):
+        names = ("dates", "transaction_ids", "account_ids", "commodity_ids", "amounts")
+        if numpy:
+            columns = {name: numpy.frombuffer(getattr(self, name), dtype=numpy.int32) for name in names[:-1]}
+            # amounts become a list once they outgrow int64
+            columns["amounts"] = numpy.frombuffer(self.amounts, dtype=numpy.int64) if isinstance(self.amounts, array) else numpy.array(self.amounts, dtype=object)
+            return columns
+        return {name: getattr(self, name) for name in names}
+
+
+def print_balance(value, currency, name=None, depth=0, out=None):
     formatted_value = f"{value:-,.2f}"
-    print(f"{formatted_value:>12s} {currency:>4s} " + ("\t" * depth) + (f"{name}" if name else ""))
+    print(f"{formatted_value:>12s} {currency:>4s} " + ("\t" * depth) + (f"{name}" if name else ""), file=out)
 
 
 def get_nested_accounts(parent, filterStr, running_total=None):
@@ -284,69 +878,134 @@ def get_nested_accounts(parent, filterStr, running_total=None):
         yield from get_nested_accounts(account, filterStr, running_total)
 
 
-def balance(root, transactions, filterStr=None, market=None, depth=None, **kwargs):
+def balance(root, transactions, filterStr=None, market=None, depth=None, out=None, **kwargs):
+    numeric = root.numeric
+    rates = {}
+
+    def convert(c, value):
+        if c not in rates:
+            rates[c] = root.getMarketPrice(c, target=market)
+        return numeric.toDecimal(c, value) * rates[c]
+
     running_total = {}
     for account in filter(lambda x: x.filterByDepth(depth), get_nested_accounts(root, filterStr, running_total=running_total)):
         if market:
-            total = 0
-            total = sum([account.getValue(c) * root.getMarketPrice(c, target=market) for c in account.getCurrencies() if account.getValue(c)])
+            total = sum([convert(c, account.getValue(c)) for c in account.getCurrencies() if account.getValue(c)])
             if total:
-                print_balance(total, market, account.getProperName(), depth=account.getDepth())
+                print_balance(total, market, account.getProperName(), depth=account.getDepth(), out=out)
         else:
             for c in account.getCurrencies():
                 if account.getValue(c):
-                    print_balance(account.getValue(c), c, account.getProperName(), depth=account.getDepth())
-    if market in account.getCurrencies():
-        total = sum([running_total[c] * root.getMarketPrice(c, target=market) for c in running_total.keys()])
-        print_balance(total, market)
+                    print_balance(numeric.toDecimal(c, account.getValue(c)), c, account.getProperName(), depth=account.getDepth(), out=out)
+    if market:
+        total = sum([convert(c, running_total[c]) for c in running_total.keys()])
+        print_balance(total, market, out=out)
     else:
         for c in running_total:
-            print_balance(running_total[c], c)
+            print_balance(numeric.toDecimal(c, running_total[c]), c, out=out)
     return running_total
 
 
-def register(root, transactions, filterStr=None, market=None, start=None, depth=None, **kwargs):
-    root = Account()
+def write_lines(lines, out=None, batch_size=1024):
+    out = out or sys.stdout
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            out.write("\n".join(batch) + "\n")
+            batch.clear()
+    if batch:
+        out.write("\n".join(batch) + "\n")
+
+
+def get_register_rows(root, transactions, filterStr=None, depth=None):
+    numeric = root.numeric
+    # rows are shown against the depth collapsed ancestor of a matching account, whose running balance covers every posting beneath it
+    candidates = {account.getAncestor(depth) for account in root.accounts.values() if account.matches(filterStr)}
+    display = {}
+    contributes = {}
+    running = defaultdict(int)
     for transaction in transactions:
         for item in transaction.items:
-            a = root.getAccount(item.account.getProperName())
-            for c in item.getCurrencies():
-                a.addValue(c, item.getValue(c))
-
-            if not item.isHidden() and (not filterStr or item.account.matches(filterStr)):
-                a = root.getAccount(item.account.getProperName()).getAncestor(depth)
-                for c in item.getCurrencies():
-                    print("{:50.50s}\t{:20.20s}\t{:3.3s}{:-12.2f}\t{:3.3s}{:-12.2f}".format(transaction.getHeader(), a.getProperName(), c, item.getValue(c), c, a.getValue(c)))
-
-
-def report(root, transactions, filterStr=None, date_index=1, market="$", invert=False, **kwargs):
-    groups = defaultdict(lambda: 0)
-    for transaction in transactions:
-        key = transaction.get_date_identifier(date_index if date_index is not None else 1)
-        for item in transaction.items:
-            if not filterStr or item.account.matches(filterStr):
-                if market:
-                    groups[key] += sum([item.getValue(c) * root.getMarketPrice(c, target=market) for c in item.getCurrencies()])
-                else:
+            account = item.account
+            targets = contributes.get(account)
+            if targets is None:
+                targets = contributes[account] = []
+                ancestor = account
+                while ancestor:
+                    if ancestor in candidates:
+                        targets.append(ancestor)
+                    ancestor = ancestor.parent
+                display[account] = account.getAncestor(depth) if account.matches(filterStr) else None
+            currencies = item.getCurrencies()
+            for a in targets:
+                for c in currencies:
+                    running[a, c] += item.getValue(c)
+
+            a = display[account]
+            if a is not None and not item.isHidden():
+                for c in currencies:
+                    yield "{:50.50s}\t{:20.20s}\t{:3.3s}{:-12.2f}\t{:3.3s}{:-12.2f}".format(transaction.getHeader(), a.getProperName(), c, numeric.toDecimal(c, item.getValue(c)), c, numeric.toDecimal(c, numeric.normalize(running[a, c])))
+
+
+def register(root, transactions, filterStr=None, market=None, start=None, depth=None, limit=None, tail=None, out=None, **kwargs):
+    rows = get_register_rows(root, transactions, filterStr, depth)
+    if limit is not None:
+        rows = itertools.islice(rows, limit)
+    if tail is not None:
+        rows = deque(rows, maxlen=tail)
+    write_lines(rows, out)
+
+
+def report(root, transactions, filterStr=None, date_index=1, market="$", invert=False, store=None, start=None, end=None, out=None, **kwargs):
+    date_index = date_index if date_index is not None else 1
+    if store is not None:
+        groups = store.groupByPeriod(filterStr, date_index, start, end)
+    else:
+        groups = defaultdict(lambda: 0)
+        for transaction in transactions:
+            key = transaction.get_date_identifier(date_index)
+            for item in transaction.items:
+                if not filterStr or item.account.matches(filterStr):
                     for c in item.getCurrencies():
-                        groups[key + c] += item.getValue(c)
+                        groups[key, c] += item.getValue(c)
+        groups = {(key, c): root.numeric.toDecimal(c, value) for (key, c), value in groups.items()}
+
+    if market:
+        # value every period at the prices in effect at its end
+        period_length = (9999, 99, 0)[date_index]
+        totals = defaultdict(lambda: 0)
+        for (key, c), value in groups.items():
+            totals[key] += value * root.getMarketPrice(c, target=market, date=date_key(key) + period_length)
+    else:
+        totals = {key + c: value for (key, c), value in groups.items()}
 
     sign = -1 if invert else 1
-    for key, value in groups.items():
-        print(f"{key:.50s}, {value * sign :-12.2f}")
+    for key, value in totals.items():
+        print(f"{key:.50s}, {value * sign :-12.2f}", file=out)
 
 
-def parse_args(args=None, lines=None):
+def build_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--file", default=os.getenv("LEDGER_FILE"))
+    parser.add_argument("--cache", default=os.getenv("PLEDGER_CACHE"), help="Directory to keep snapshots of the parsed ledger in")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of processes to parse the ledger's lines with; entries are still committed in order")
+    parser.add_argument("--incremental", default=False, action="store_const", const=True, help="Resume parsing from a checkpoint in --cache when the ledger was only appended to")
+    parser.add_argument("--socket", default=os.getenv("PLEDGER_SOCKET", os.path.join(os.getenv("XDG_RUNTIME_DIR", "/tmp"), "pledger-{}.sock".format(os.getuid()))), help="Unix socket of a `pledger serve` daemon to forward queries to; set to an empty string to always parse locally")
 
     parser.add_argument("--sorted", default=False, action="store_const", const=True)
     parser.add_argument("--start")
     parser.add_argument("--end")
     parser.add_argument("--market", action="store_const", const="$")
+    parser.add_argument("-X", "--exchange", dest="market", metavar="COMMODITY", help="Convert amounts to COMMODITY")
+    parser.add_argument("--price-db", help="File of P directives with historical prices")
+    parser.add_argument("--fixed-point", default=False, action="store_const", const=True, help="Use exact integer arithmetic instead of Decimal")
+    parser.add_argument("--precision", action="append", default=[], metavar="COMMODITY=DIGITS", help="Declare the number of decimal places kept for a commodity in --fixed-point mode")
+    parser.add_argument("--profile", default=False, action="store_const", const=True, help="Print phase timings and counters as JSON to stderr; commit, auto and periodic are part of parse")
 
     shared_parser = argparse.ArgumentParser(add_help=False)
     shared_parser.add_argument("accounts", default=None, nargs="*")
+    shared_parser.add_argument("--watch", default=False, action="store_const", const=True, help="Keep running and re-render whenever the ledger changes")
 
     sub_parsers = parser.add_subparsers(dest="type")
 
@@ -357,6 +1016,8 @@ def parse_args(args=None, lines=None):
 
     register_parser = sub_parsers.add_parser("register", description="List items involving account", aliases=["reg", "r"], parents=[shared_parser])
     register_parser.add_argument("--depth", "-d", type=int)
+    register_parser.add_argument("--limit", type=int, help="Stop after the first LIMIT rows")
+    register_parser.add_argument("--tail", type=int, help="Only show the last TAIL rows")
     register_parser.set_defaults(func=register)
 
     report_parser = sub_parsers.add_parser("report", description="List items involving account", aliases=["rep"], parents=[shared_parser])
@@ -366,19 +1027,241 @@ def parse_args(args=None, lines=None):
     report_parser.add_argument("--yearly", "-y", action="store_const", const=0, dest="date_index")
     report_parser.set_defaults(func=report)
 
-    namespace = parser.parse_args(args)
-    ledger_file = namespace.file
+    sub_parsers.add_parser("serve", description="Keep the parsed ledger in memory and answer queries on --socket")
+    return parser
+
 
+def get_precision(namespace):
+    if namespace.fixed_point or namespace.precision:
+        return {c: int(digits) for c, digits in (p.rsplit("=", 1) for p in namespace.precision)}
+
+
+def load_ledger(namespace, lines=None, stats=None, plan=None):
+    precision = get_precision(namespace)
     if lines:
-        root, transactions = parse_file(lines, check_sorted=namespace.sorted, end=namespace.end)
+        root, transactions = parse_file(lines, check_sorted=namespace.sorted, end=namespace.end, precision=precision, stats=stats, plan=plan)
     else:
-        with open(ledger_file, "r") as f:
-            root, transactions = parse_file(f, check_sorted=namespace.sorted, end=namespace.end)
+        root, transactions = parse_path(namespace.file, cache=namespace.cache, incremental=namespace.incremental, jobs=namespace.jobs, check_sorted=namespace.sorted, end=namespace.end, precision=precision, stats=stats, plan=plan)
+
+    if namespace.price_db:
+        with phase(stats, "price_db"), open(namespace.price_db) as f:
+            root.market.load(f)
+    return root, transactions
+
+
+def plan_query(namespace):
+    func = getattr(namespace, "func", None)
+    if func is balance:
+        # balance only reads the account tree
+        return QueryPlan(retain=False)
+    accountFilter = AccountFilter(namespace.accounts) if namespace.accounts else None
+    startKey = date_key(namespace.start) if namespace.start else None
+    if func is register:
+        # with --depth rows are shown against collapsed ancestors, which aren't known until every account has been seen
+        return QueryPlan(startKey=startKey, accountFilter=accountFilter if namespace.depth is None else None, ancestors=True)
+    if func is report:
+        return QueryPlan(startKey=startKey, accountFilter=accountFilter)
+
 
+def run_query(namespace, root, transactions, store=None, out=None):
     kwargs = {k: v for k, v in vars(namespace).items()}
-    if kwargs.get("start") is not None:
-        transactions = filter(lambda x: x.date < namespace.start, transactions)
-    namespace.func(root, transactions, namespace.accounts, **kwargs,)
+    if namespace.start is not None or namespace.end is not None:
+        transactions = DateIndex(transactions).range(namespace.start, namespace.end)
+    accountFilter = AccountFilter(namespace.accounts) if namespace.accounts else None
+    namespace.func(root, transactions, accountFilter, store=store, out=out, **kwargs,)
+
+
+def parse_args(args=None, lines=None):
+    if args is None:
+        args = sys.argv[1:]
+    namespace = build_arg_parser().parse_args(args)
+    if namespace.type == "serve":
+        return serve(namespace)
+    if namespace.watch and not lines:
+        return watch(namespace)
+    # the daemon opens the ledger itself, which it can't do for the other end of a pipe
+    if not lines and not namespace.profile and namespace.socket and (not namespace.file or os.path.isfile(namespace.file)) and forward_query(namespace.socket, args):
+        return
+
+    stats = Stats() if namespace.profile else None
+    root, transactions = load_ledger(namespace, lines, stats, plan_query(namespace))
+    with phase(stats, "render"):
+        run_query(namespace, root, transactions)
+    if stats is not None:
+        sys.stdout.flush()
+        print(json.dumps(stats.toDict(), indent=2), file=sys.stderr)
+    return stats
+
+
+def is_own_socket(path):
+    # anyone can create the default path in a shared /tmp, so only talk to a daemon this user started
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if S_ISSOCK(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077:
+        return True
+    logging.warning("Not forwarding to %s; it is not a socket private to this user", path)
+    return False
+
+
+def forward_query(socket_path, args):
+    if not is_own_socket(socket_path):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall(json.dumps({"args": args, "cwd": os.getcwd(), "file": os.getenv("LEDGER_FILE")}).encode() + b"\n")
+            response = json.loads(sock.makefile("rb").read())
+    except (FileNotFoundError, ConnectionRefusedError):
+        # no daemon is listening
+        return False
+    sys.stdout.write(response["output"])
+    sys.stderr.write(response["error"])
+    if response["status"]:
+        sys.exit(response["status"])
+    return True
+
+
+def get_stamps(paths):
+    stamps = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamps.append((path, stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            stamps.append((path, None, None))
+    return tuple(stamps)
+
+
+class QueryDaemon:
+
+    def __init__(self, max_results=256):
+        self.states = {}
+        # key -> future of the parse in flight, so concurrent stale queries share one
+        self.parsing = {}
+        self.results = {}
+        self.max_results = max_results
+
+    @staticmethod
+    def getKey(namespace):
+        # only the options that change what gets parsed need a tree of their own
+        return (namespace.file, namespace.sorted, namespace.end, namespace.price_db, namespace.fixed_point, tuple(namespace.precision))
+
+    def getStamp(self, namespace, root=None):
+        if root is None:
+            state = self.states.get(self.getKey(namespace))
+            root = state[1][0] if state else None
+        includes = list(root.includes) if root else []
+        return get_stamps([path for path in (namespace.file, namespace.price_db) if path] + includes)
+
+    def load(self, namespace):
+        # runs on a worker thread, so it leaves self.states to the loop
+        logging.info("Parsing %s", namespace.file)
+        root, transactions = load_ledger(namespace)
+        # restamp now that the included files are known
+        return self.getStamp(namespace, root), (root, transactions), None
+
+    async def getState(self, namespace, stamp):
+        key = self.getKey(namespace)
+        while True:
+            state = self.states.get(key)
+            if state is not None and state[0] == stamp:
+                return state[1]
+            pending = self.parsing.get(key)
+            if pending is not None:
+                # the file may change again while it parses, so check the stamp once more afterwards
+                await asyncio.shield(pending)
+                continue
+            # parse off the loop so queries against other ledgers and cached results keep being answered
+            pending = self.parsing[key] = asyncio.get_running_loop().run_in_executor(None, self.load, namespace)
+            try:
+                state = self.states[key] = await asyncio.shield(pending)
+            finally:
+                del self.parsing[key]
+            return state[1]
+
+    def getStore(self, namespace):
+        # built on the first report against each parsed state and dropped with it
+        key = self.getKey(namespace)
+        stamp, (root, transactions), store = self.states[key]
+        if store is None:
+            store = PostingStore().extend(transactions)
+            self.states[key] = (stamp, (root, transactions), store)
+        return store
+
+    def parseArgs(self, args, cwd, file):
+        parser = build_arg_parser()
+        parser.set_defaults(file=file)
+        namespace = parser.parse_args(args)
+        if namespace.type in (None, "serve"):
+            parser.error("expected one of balance, register or report")
+        namespace.file = os.path.abspath(os.path.join(cwd, namespace.file))
+        if namespace.price_db:
+            namespace.price_db = os.path.abspath(os.path.join(cwd, namespace.price_db))
+        return namespace
+
+    async def query(self, args, cwd="", file=None):
+        output, error = io.StringIO(), io.StringIO()
+        status, key = 0, None
+        try:
+            # argparse only writes to the process streams; this doesn't yield, and nothing else writes to them meanwhile
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(error):
+                namespace = self.parseArgs(args, cwd, file)
+            stamp = self.getStamp(namespace)
+            key = (tuple(args), namespace.file, namespace.price_db)
+            result = self.results.get(key)
+            if result and result[0] == stamp:
+                return result[1]
+            root, transactions = await self.getState(namespace, stamp)
+            # rendering doesn't yield, so the store goes with the state it was built for
+            run_query(namespace, root, transactions, store=self.getStore(namespace) if namespace.func is report else None, out=output)
+        except SystemExit as e:
+            status = e.code
+        except Exception as e:
+            print(e, file=error)
+            status = 1
+        result = {"status": status, "output": output.getvalue(), "error": error.getvalue()}
+        if not status and key:
+            if len(self.results) >= self.max_results:
+                self.results.clear()
+            self.results[key] = (stamp, result)
+        return result
+
+    async def handle(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            response = await self.query(request["args"], request.get("cwd", ""), request.get("file"))
+            writer.write(json.dumps(response).encode())
+            await writer.drain()
+        except (ValueError, KeyError, ConnectionError) as e:
+            logging.error("Bad request: %s", e)
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(self.handle, socket_path)
+        os.chmod(socket_path, 0o600)
+        logging.info("Listening on %s", socket_path)
+        async with server:
+            await server.serve_forever()
+
+
+def serve(namespace):
+    daemon = QueryDaemon()
+    if namespace.file:
+        namespace.file = os.path.abspath(namespace.file)
+        daemon.states[daemon.getKey(namespace)] = daemon.load(namespace)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        asyncio.run(daemon.serve(namespace.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if os.path.exists(namespace.socket):
+            os.unlink(namespace.socket)
 
 
 def next_date(date, index):
@@ -396,17 +1279,185 @@ def next_date(date, index):
             return next_date(date.replace(day=1), 1)
 
 
-def parse_file(f, root=None, check_sorted=False, end=None):
-    if root is None:
-        root = Account()
+class PeriodicScheduler:
+
+    def __init__(self):
+        self.heap = []
+        self.labels = defaultdict(list)
+        self.cancelled = set()
+        self.sequence = 0
+
+    def add(self, date, label, index):
+        items = []
+        heapq.heappush(self.heap, (date, label, index, self.sequence, items))
+        self.labels[label].append(self.sequence)
+        self.sequence += 1
+        return items
+
+    def cancel(self, label):
+        if self.labels.get(label):
+            self.cancelled.add(self.labels[label].pop(0))
+
+    def due(self, date):
+        while self.heap:
+            d, label, index, sequence, items = self.heap[0]
+            if sequence in self.cancelled:
+                heapq.heappop(self.heap)
+                self.cancelled.remove(sequence)
+            elif d > date:
+                break
+            else:
+                heapq.heapreplace(self.heap, (next_date(d, index), label, index, sequence, items))
+                yield d, label, items
+
+
+POSTING, ENTRY, DIRECTIVE = range(3)
+
+
+# Everything about a line that doesn't depend on the lines before it, so it can be worked out in another process:
+# (POSTING, account, token, amounts), (ENTRY, date key, date, title) or (DIRECTIVE, data, tokens); None for blanks and comments
+def prepare_line(line):
+    data = line.split(";", 1)[0]
+    itemStr = data.split()
+    if not itemStr or data[0] in ";#%|*":
+        return None
+    if data[0] in whitespace:
+        token = " ".join(itemStr[1:])
+        return POSTING, itemStr[0], token, parse_amount(token) if token else None
+    if data[0].isdigit():
+        return ENTRY, date_key(itemStr[0]), itemStr[0], " ".join(itemStr[1:])
+    return DIRECTIVE, data, itemStr
+
+
+def format_line(tokens):
+    if tokens[0] == POSTING:
+        return "    {} {}".format(tokens[1], tokens[2])
+    return "{} {}".format(tokens[2], tokens[3])
+
+
+class Stats:
+    # profiling data belongs to one run; it pickles as None so it never ends up in snapshots or checkpoints
+
+    def __init__(self):
+        self.phases = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    def __reduce__(self):
+        return (type(None), ())
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def toDict(self):
+        return {"phases": {name: round(seconds, 6) for name, seconds in self.phases.items()}, "counters": dict(self.counters)}
+
+
+def phase(stats, name):
+    return stats.phase(name) if stats is not None else contextlib.nullcontext()
+
 
-    transactions = []
-    auto_transactions = []
-    periodic_transactions = []
-    t = last_t = None
-    lastDate = None
+class Parser:
 
-    def periodic_transaction_helper(p_type, label, lastDate):
+    def __init__(self, root=None, check_sorted=False, end=None, precision=None, stats=None, path=None, cache=None, plan=None):
+        if root is None:
+            root = Account(numeric=FixedPointBackend(precision) if precision is not None else None)
+        self.root = root
+        self.check_sorted = check_sorted
+        self.end = end
+        self.endKey = date_key(end) if end is not None else None
+        self.transactions = []
+        self.last_transaction = None
+        self.plan = plan
+        # where each uncommitted transaction sits in transactions, so the plan can drop it once its postings are known
+        self.pending = {}
+        self.dropped = 0
+        self.auto_transactions = AutoTransactionIndex()
+        self.periodic_transactions = PeriodicScheduler()
+        self.t = self.last_t = None
+        self.lastDate = None
+        self.line_num = 0
+        self.done = False
+        self.path = path
+        self.cache = cache
+        self.including = {os.path.abspath(path)} if path else set()
+        self.setStats(stats)
+
+    def setStats(self, stats):
+        self.stats = self.root.stats = stats
+
+    def commit(self, t):
+        if self.stats is None:
+            t.commit()
+        else:
+            self.stats.count("commits")
+            with self.stats.phase("commit"):
+                t.commit()
+        if self.plan is not None:
+            index = self.pending.pop(t, None)
+            if index is not None and not self.plan.keep(t):
+                self.transactions[index] = None
+                self.dropped += 1
+
+    def addTransaction(self, t):
+        if self.check_sorted and self.last_transaction and self.last_transaction > t:
+            logging.warning("Not sorted %s %s", self.last_transaction, t)
+        self.last_transaction = t
+        if self.plan is not None:
+            if not self.plan.retain:
+                return
+            self.pending[t] = len(self.transactions)
+        self.transactions.append(t)
+
+    def endEntry(self):
+        if isinstance(self.last_t, Transaction):
+            self.commit(self.last_t)
+        self.t = self.last_t = None
+
+    def include(self, pattern):
+        pattern = os.path.join(os.path.dirname(self.path) if self.path else "", os.path.expanduser(pattern))
+        paths = sorted(glob.glob(pattern))
+        if not paths:
+            raise FileNotFoundError("No files match include {}".format(pattern))
+        # an included file starts and ends its own entries
+        self.endEntry()
+        for path in paths:
+            path = os.path.abspath(path)
+            if path in self.including:
+                raise ValueError("Circular include of {}".format(path))
+            # the key is only compared against when a cached state is reused, so don't hash without a cache
+            if self.cache:
+                self.root.includes[path], lines = load_tokens(path, self.cache)
+            else:
+                self.root.includes[path], lines = None, prepare_chunk(path, 0, None)[1]
+            outer = self.path, self.line_num
+            self.path, self.line_num = path, 0
+            self.including.add(path)
+            try:
+                for line_num, line, tokens in lines:
+                    if not self.parse_line(line, line_num, tokens):
+                        break
+                last_t = self.last_t
+                try:
+                    self.endEntry()
+                except Exception:
+                    logging.error("Error processing %s:%d %s", path, last_t.line_num, last_t.getHeader())
+                    raise
+            finally:
+                self.including.discard(path)
+                self.path, self.line_num = outer
+            # --end stops the whole ledger, not just this file
+            if self.done:
+                break
+
+    def periodic_transaction_helper(self, p_type, label, lastDate):
         if p_type == "yearly":
             index = 0
             d = next_date(lastDate.replace(month=1), index)
@@ -416,106 +1467,569 @@ def parse_file(f, root=None, check_sorted=False, end=None):
         elif p_type == "daily":
             index = 2
             d = next_date(lastDate, index)
-        l = []
-        periodic_transactions.append([d, label, index, l])
-        periodic_transactions.sort()
-        return l
-
-    def helper(t, itemStr, line_num):
-        item = t.addItem(itemStr[0], " ".join(itemStr[1:]), line_num=line_num)
+        return self.periodic_transactions.add(d, label, index)
+
+    def rescale(self, currency, digits, t):
+        # everything still reachable that holds amounts: the transactions kept or being built and the automatic rules
+        transactions = set(filter(None, self.transactions))
+        transactions.update(x for x in (t, self.last_t) if isinstance(x, Transaction))
+        items = [item for x in transactions for item in x.items]
+        items += [item for auto_transaction in self.auto_transactions for item, _ in auto_transaction.items]
+        logging.debug("Keeping %d decimal places of %s", digits, currency)
+        self.root.numeric.rescale(currency, digits, [self.root, *self.root.accounts.values()], items)
+
+    def helper(self, t, account, token, line_num, amounts=None):
+        while True:
+            try:
+                item = t.addItem(account, token, line_num=line_num, amounts=amounts)
+                break
+            except PrecisionTooLow as e:
+                self.rescale(e.currency, e.digits, t)
         if isinstance(item, AutoTransaction):
             return
 
-        for auto_transaction in auto_transactions:
-            if auto_transaction != t and auto_transaction.matchesTransactionItem(item):
-                auto_transaction.addToTransaction(t, item)
-    line_num = 0
-    for line in f:
-        line_num += 1
+        stats = self.stats
+        if stats is None:
+            for auto_transaction in self.auto_transactions.match(item.account):
+                if auto_transaction != t:
+                    auto_transaction.addToTransaction(t, item)
+            return
+
+        if not isinstance(t, AutoTransaction):
+            stats.count("postings")
+        stats.count("auto_attempts")
+        with stats.phase("auto"):
+            for auto_transaction in self.auto_transactions.match(item.account):
+                if auto_transaction != t:
+                    stats.count("auto_hits")
+                    auto_transaction.addToTransaction(t, item)
+
+    def expandPeriodic(self, line_num):
+        for d, label, items in self.periodic_transactions.due(self.lastDate):
+            if self.stats is not None:
+                self.stats.count("periodic_occurrences")
+            t = Transaction(date=d.strftime('%Y/%m/%d'), title=label, root=self.root, line_num=line_num)
+            self.addTransaction(t)
+            for account, token in items:
+                self.helper(t, account, token, line_num)
+            self.commit(t)
+
+    def parse(self, f):
+        start = self.line_num
+        for line in f:
+            if not self.parse_line(line):
+                break
+        if self.stats is not None:
+            self.stats.count("lines", self.line_num - start)
+        return self
+
+    def parse_numbered(self, lines):
+        for line_num, line in lines:
+            if not self.parse_line(line, line_num):
+                break
+        return self
+
+    def parse_line(self, line, line_num=None, tokens=None):
+        self.line_num = self.line_num + 1 if line_num is None else line_num
+        line_num = self.line_num
+        if self.stats is not None:
+            # LineReader drops blanks and comments before they get here; "lines" counts every line read
+            self.stats.count("parsed_lines")
+        root, t = self.root, self.t
         try:
-            commentSplit = line.split(";")
-            data, _ = commentSplit[0], commentSplit[1:]
-
-            if data.strip():
-                itemStr = data.split()
-                if data[0] in whitespace:
-                    if isinstance(t, list):
-                        t.append(itemStr)
-                    elif t:
-                        helper(t, itemStr, line_num)
-
-                elif data[0] in ";#%|*":  # is comment
-                    pass
-                elif data[0] == "~":  # is perodic expression; currently unsupported
-                    t = periodic_transaction_helper(itemStr[0][1:], label=data[1:], lastDate=lastDate)
+            if tokens is None:
+                tokens = prepare_line(line)
+
+            if not tokens:
+                pass
+            elif tokens[0] == POSTING:
+                _, account, token, amounts = tokens
+                if isinstance(t, list):
+                    t.append((account, token))
+                elif t:
+                    self.helper(t, account, token, line_num, amounts)
+            elif tokens[0] == ENTRY:
+                _, key, date, title = tokens
+                if self.end is not None and key > self.endKey:
+                    self.done = True
+                    return False
+                self.lastDate = datetime.date(key // 10000, key // 100 % 100, key % 100)
+                with phase(self.stats, "periodic"):
+                    self.expandPeriodic(line_num)
+                t = Transaction(date=date, title=title, root=root, line_num=line_num, dateKey=key)
+                self.addTransaction(t)
+            else:
+                _, data, itemStr = tokens
+                if data[0] == "~":  # is perodic expression; currently unsupported
+                    t = self.periodic_transaction_helper(itemStr[0][1:], label=data[1:], lastDate=self.lastDate)
                 elif data[0] == "=":  # is automatic expression
                     t = AutoTransaction(itemStr[1], root=root, label=itemStr[2:])
-                    auto_transactions.append(t)
+                    self.auto_transactions.add(t)
                 elif data[0] == "I":
                     if t:
-                        t.commit()
-                        t = last_t = None
-                    match = re.search("I ([\w:]*) ~(\w*) ([0-9\.\+-/ )(]*) ([\w:]*) ([\w:]*) ?(.*)", line)
+                        self.commit(t)
+                        t = self.last_t = None
+                    match = re.search(r"I ([\w:]*) ~(\w*) ([0-9\.\+-/ )(]*) ([\w:]*) ([\w:]*) ?(.*)", line)
                     accountName = match.group(1)
                     value = match.group(3)
                     label = match.group(6) or ("Interest " + accountName)
                     interestSourceAccount, interestDestAccount = match.group(4), match.group(5)
-                    p_trans = periodic_transaction_helper(match.group(2), label, lastDate)
+                    p_trans = self.periodic_transaction_helper(match.group(2), label, self.lastDate)
                     p_trans.append((f".{accountName}", "=$0"))
                     p_trans.append((interestSourceAccount, ""))
 
                     a_trans = AutoTransaction(f"^{accountName}$", root=root, label=label)
                     a_trans.addItem(f".{accountName}", "-1", line_num=line_num)
                     a_trans.addItem(interestDestAccount, token=value, line_num=line_num)
-                    auto_transactions.append(a_trans)
+                    self.auto_transactions.add(a_trans)
 
                 elif data[0] == "C":
                     label = " ".join(itemStr[1:])
-                    for a in auto_transactions:
-                        if a.label == label:
-                            auto_transactions.remove(a)
-                            break
-                    for p in periodic_transactions:
-                        if p[1] == label:
-                            periodic_transactions.remove(p)
-                            break
-
+                    self.auto_transactions.remove(label)
+                    self.periodic_transactions.cancel(label)
+
+                elif itemStr[0] in ("include", "!include"):
+                    self.include(data.split(None, 1)[1].strip())
+                    if self.done:
+                        return False
+                    t = None
                 elif data[0] == "P":
                     _, date, currency, value = data.split()
-
-                    v = Decimal(currency_regex.sub("", value))
-                    c = getCurrencySymbol(value)
-                    root.setMarketPrice(currency, c, v)
-                elif data[0].isdigit():
-                    if end is not None and itemStr[0] > end:
-                        break
-                    lastDate = datetime.date(*list(map(int, itemStr[0].split("/"))))
-                    while periodic_transactions and lastDate >= periodic_transactions[0][0]:
-                        t = Transaction(date=periodic_transactions[0][0].strftime('%Y/%m/%d'), title=periodic_transactions[0][1], root=root, line_num=line_num)
-                        transactions.append(t)
-                        for args in periodic_transactions[0][-1]:
-                            helper(t, args, line_num)
-                        t.commit()
-                        periodic_transactions[0][0] = next_date(periodic_transactions[0][0], periodic_transactions[0][-2])
-                        periodic_transactions.sort()
-                    t = Transaction(date=itemStr[0], title=" ".join(itemStr[1:]), root=root, line_num=line_num)
-                    if check_sorted and transactions:
-                        if transactions[-1] > t:
-                            logging.warning("Not sorted %s %s", transactions[-1], t)
-                    transactions.append(t)
+                    (c, v), _, _ = parse_amount(value)
+                    root.setMarketPrice(currency, c, v, date_key(date))
+            if isinstance(self.last_t, Transaction) and self.last_t != t:
+                self.commit(self.last_t)
         except Exception as e:
-            logging.error("Error processing line #%d %s", line_num, line)
+            if line is None:
+                # only directives keep their text once prepared
+                line = format_line(tokens)
+            if self.path:
+                logging.error("Error processing %s:%d %s", self.path, line_num, line.rstrip())
+            else:
+                logging.error("Error processing line #%d %s", line_num, line)
             raise e
-        if isinstance(last_t, Transaction) and last_t != t:
-            last_t.commit()
-        last_t = t
+        self.t = self.last_t = t
+        return True
+
+    def finish(self):
+        if isinstance(self.last_t, Transaction):
+            self.commit(self.last_t)
+        # forget the open entry so finishing is idempotent and parsing can go on with a new one
+        self.t = self.last_t = None
+        if self.dropped:
+            self.transactions = [t for t in self.transactions if t is not None]
+            self.dropped = 0
+        return self.root, self.transactions
+
+
+class LineReader:
+    skip_regex = re.compile(rb"[ \t\r\f\v]*(?:;.*)?\n?|[;#%|*].*\n?")
+
+    def __init__(self, f, offset=0, line_num=0, end=None):
+        self.f = f
+        self.offset = offset
+        self.line_num = line_num
+        self.end = end
 
-    if transactions:
-        last_t.commit()
+    def __iter__(self):
+        st = os.fstat(self.f.fileno())
+        if not S_ISREG(st.st_mode):
+            # pipes and FIFOs have no size and can't be mapped, so read them a line at a time
+            yield from self.readStream()
+            return
+        size = st.st_size
+        if self.end is not None:
+            size = min(size, self.end)
+        if self.offset >= size:
+            return
+        with mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            find, skip = mm.find, self.skip_regex.fullmatch
+            pos = self.offset
+            while pos < size:
+                end = find(b"\n", pos)
+                end = size if end == -1 else end + 1
+                self.line_num += 1
+                self.offset = end
+                if not skip(mm, pos, end):
+                    yield self.line_num, mm[pos:end].decode()
+                pos = end
+
+    def readStream(self):
+        skip = self.skip_regex.fullmatch
+        for line in self.f:
+            self.line_num += 1
+            self.offset += len(line)
+            if not skip(line):
+                yield self.line_num, line.decode()
+            if self.end is not None and self.offset >= self.end:
+                break
+
+
+block_regex = re.compile(rb"\n(?=[^ \t\r\n])")
+
+
+def prepare_chunk(path, start, end):
+    lines = []
+    names = {}
+    with open(path, "rb") as f:
+        reader = LineReader(f, start, end=end)
+        for line_num, line in reader:
+            try:
+                tokens = prepare_line(line)
+            except Exception:
+                # leave it to the parser, which reports the line it fails on
+                lines.append((line_num, line, None))
+                continue
+            if tokens is None:
+                continue
+            if tokens[0] == DIRECTIVE:
+                lines.append((line_num, line, tokens))
+                continue
+            if tokens[0] == POSTING:
+                # a shared name pickles once per chunk
+                tokens = (POSTING, names.setdefault(tokens[1], tokens[1]), tokens[2], tokens[3])
+            lines.append((line_num, None, tokens))
+    return reader.line_num, lines
+
+
+def parse_parallel(parser, f, jobs, chunk_size=None):
+    size = os.fstat(f.fileno()).st_size
+    if not size:
+        return parser
+    chunk_size = chunk_size or max(size // (jobs * 4), 1 << 20)
+    boundaries = [0]
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while boundaries[-1] + chunk_size < size:
+            match = block_regex.search(mm, boundaries[-1] + chunk_size)
+            if not match:
+                break
+            boundaries.append(match.end())
+    boundaries.append(size)
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        line_offset = 0
+        chunks = executor.map(prepare_chunk, [f.name] * (len(boundaries) - 1), boundaries[:-1], boundaries[1:])
+        for line_count, lines in chunks:
+            if parser.stats is not None:
+                parser.stats.count("lines", line_count)
+            for line_num, line, tokens in lines:
+                if not parser.parse_line(line, line_offset + line_num, tokens):
+                    executor.shutdown(cancel_futures=True)
+                    return parser
+            line_offset += line_count
+    return parser
+
+
+def parse_file(f, root=None, check_sorted=False, end=None, store=None, precision=None, stats=None, path=None, cache=None, plan=None):
+    # includes are resolved relative to path, which defaults to the name of f when it is a file
+    path = path or getattr(f, "name", None)
+    with phase(stats, "parse"):
+        root, transactions = Parser(root, check_sorted=check_sorted, end=end, precision=precision, stats=stats, path=path, cache=cache, plan=plan).parse(f).finish()
+    if store is not None:
+        store.extend(transactions)
+    return root, transactions
+
+
+# bump whenever the pickled classes change so stale snapshots and checkpoints are ignored
+CACHE_VERSION = 5
+
+
+def get_cache_path(cache, path, suffix):
+    return os.path.join(cache, hashlib.sha1(os.path.abspath(path).encode()).hexdigest() + suffix)
+
+
+def get_file_key(path, **kwargs):
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return (CACHE_VERSION, os.path.abspath(path), stat.st_size, stat.st_mtime_ns, digest, sorted(kwargs.items()))
+
+
+def load_snapshot(cache_path, key):
+    # the snapshot is one large, long-lived object graph; keep the cyclic GC from rescanning it
+    gc.disable()
+    try:
+        with open(cache_path, "rb") as f:
+            if pickle.load(f) == key:
+                return pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning("Ignoring unreadable snapshot %s: %s", cache_path, e)
+    finally:
+        gc.enable()
+
+
+def save_snapshot(cache_path, key, state):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+
+def load_checkpoint(cache_path, f, params):
+    gc.disable()
+    try:
+        with open(cache_path, "rb") as checkpoint:
+            checkpoint_params, offset, digest = pickle.load(checkpoint)
+            if checkpoint_params == params:
+                prefix_hash = hashlib.sha256(f.read(offset))
+                if prefix_hash.hexdigest() == digest:
+                    return pickle.load(checkpoint), offset, prefix_hash
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning("Ignoring unreadable checkpoint %s: %s", cache_path, e)
+    finally:
+        gc.enable()
+    f.seek(0)
+    return None, 0, hashlib.sha256()
+
+
+def load_tokens(path, cache):
+    cache_path = get_cache_path(cache, path, ".tokens")
+    key = get_file_key(path)
+    lines = load_snapshot(cache_path, key)
+    if lines is None:
+        lines = prepare_chunk(path, 0, None)[1]
+        save_snapshot(cache_path, key, lines)
+    return key, lines
+
+
+def includes_unchanged(root):
+    try:
+        return all(get_file_key(path) == key for path, key in root.includes.items())
+    except FileNotFoundError:
+        return False
+
+
+def parse_incremental(path, cache, stats=None, **kwargs):
+    cache_path = get_cache_path(cache, path, ".checkpoint")
+    params = [CACHE_VERSION, *sorted(kwargs.items())]
+    with open(path, "rb") as f:
+        parser, offset, prefix_hash = load_checkpoint(cache_path, f, params)
+        if parser and not includes_unchanged(parser.root):
+            parser, offset, prefix_hash = None, 0, hashlib.sha256()
+        if parser:
+            logging.debug("Resuming %s from line %d", path, parser.line_num)
+            parser.setStats(stats)
+        else:
+            parser = Parser(stats=stats, path=path, cache=cache, **kwargs)
+        start = parser.line_num
+        reader = LineReader(f, offset, start)
+        parser.parse_numbered(reader)
+        if stats is not None:
+            stats.count("lines", reader.line_num - start)
+        if reader.offset != offset and not parser.done:
+            f.seek(offset)
+            data = f.read(reader.offset - offset)
+            # only checkpoint at the end of a complete line so a later append can't extend a line that was already parsed
+            if data.endswith(b"\n"):
+                prefix_hash.update(data)
+                parser.line_num = reader.line_num
+                save_snapshot(cache_path, (params, reader.offset, prefix_hash.hexdigest()), parser)
+    return parser.finish()
+
+
+def common_prefix_length(a, b, step=1 << 16):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i:i + step] == b[i:i + step]:
+        i += step
+    i = min(i, n)
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class LedgerWatcher:
+
+    def __init__(self, path, max_checkpoints=4, **kwargs):
+        self.path = path
+        self.kwargs = kwargs
+        self.max_checkpoints = max_checkpoints
+        # (offset, line_num, pickled unfinished Parser) taken at the start of an entry, ordered by offset
+        self.checkpoints = []
+        self.data = b""
+        self.parser = None
+        self.line_num = 0
+        self.stamp = None
+        self.include_stamps = ()
+        self.update()
+
+    def getStamp(self):
+        stat = os.stat(self.path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def includesChanged(self):
+        return get_stamps(path for path, _, _ in self.include_stamps) != self.include_stamps
+
+    def changed(self):
+        return self.getStamp() != self.stamp or self.includesChanged()
+
+    def getState(self):
+        return self.parser.root, self.parser.transactions
+
+    def update(self):
+        if self.includesChanged():
+            # only the main file is compared byte by byte, so start over when an included one changed
+            self.parser, self.data, self.checkpoints = None, b"", []
+        # stat before reading so a write racing with the read shows up on the next poll
+        self.stamp = self.getStamp()
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+                offset = common_prefix_length(self.data, data)
+                if not (self.parser and offset == len(self.data) and self.append(f, offset)):
+                    self.resume(f, data, offset)
+            self.data = data
+            self.include_stamps = get_stamps(self.parser.root.includes)
+        except Exception:
+            # the live parser may be half updated; the next update starts from a checkpoint
+            self.parser, self.data = None, b""
+            raise
+
+    def append(self, f, offset):
+        if self.data and not self.data.endswith(b"\n"):
+            return False
+        if self.parser.done:
+            return True
+        reader = LineReader(f, offset, self.line_num)
+        lines = iter(reader)
+        first = next(lines, None)
+        if first is None:
+            return True
+        # anything but a new entry could still belong to the transaction finish() already committed
+        if not (first[1][0].isdigit() or first[1][0] in "=~I"):
+            return False
+        logging.debug("Applying lines appended to %s after line %d", self.path, self.line_num)
+        self.parser.parse_numbered(itertools.chain([first], lines))
+        self.parser.finish()
+        self.line_num = reader.line_num
+        return True
 
+    @staticmethod
+    def getEntryStart(data, offset):
+        start = data.rfind(b"\n", 0, offset) + 1
+        while start and data[start:start + 1] in (b" ", b"\t"):
+            start = data.rfind(b"\n", 0, start - 1) + 1
+        return start
+
+    def resume(self, f, data, offset):
+        start = self.getEntryStart(data, offset)
+        self.checkpoints = [checkpoint for checkpoint in self.checkpoints if checkpoint[0] <= start]
+        if self.checkpoints:
+            checkpoint_offset, line_num, blob = self.checkpoints[-1]
+            gc.disable()
+            try:
+                parser = pickle.loads(blob)
+            finally:
+                gc.enable()
+        else:
+            checkpoint_offset, line_num, parser = 0, 0, Parser(path=self.path, **self.kwargs)
+        logging.debug("Reparsing %s from line %d", self.path, line_num)
+
+        if self.data:
+            # edits tend to cluster, so remember a state a little in front of this one for the next; pickling
+            # costs about half a full parse, so only bother when it saves re-parsing a good part of the file
+            targets, min_gap = [max(start - len(data) // 16, checkpoint_offset)], len(data) // 4
+        else:
+            # a full parse has no edit to go by, so spread states over the file for the first edit to resume from
+            targets, min_gap = [len(data) * i // self.max_checkpoints for i in range(1, self.max_checkpoints)], 0
+        for target in targets:
+            target = self.getEntryStart(data, target)
+            if target - checkpoint_offset <= min_gap:
+                continue
+            reader = LineReader(f, checkpoint_offset, line_num, end=target)
+            parser.parse_numbered(reader)
+            checkpoint_offset, line_num = target, reader.line_num
+            if parser.done:
+                break
+            self.checkpoints.append((target, line_num, pickle.dumps(parser, pickle.HIGHEST_PROTOCOL)))
+        del self.checkpoints[:-self.max_checkpoints]
+        reader = LineReader(f, checkpoint_offset, line_num)
+        if not parser.done:
+            parser.parse_numbered(reader)
+        parser.finish()
+        self.parser, self.line_num = parser, reader.line_num
+
+
+def watch(namespace, interval=1):
+    watcher = LedgerWatcher(namespace.file, check_sorted=namespace.sorted, end=namespace.end, precision=get_precision(namespace))
+    root = None
+    try:
+        while True:
+            if watcher.parser:
+                if watcher.parser.root is not root:
+                    root = watcher.parser.root
+                    if namespace.price_db:
+                        with open(namespace.price_db) as f:
+                            root.market.load(f)
+                if sys.stdout.isatty():
+                    sys.stdout.write("\033[H\033[2J")
+                run_query(namespace, *watcher.getState())
+                sys.stdout.flush()
+            while not watcher.changed():
+                time.sleep(interval)
+            try:
+                watcher.update()
+            except Exception as e:
+                logging.error("Failed to reparse %s: %s", namespace.file, e)
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_path(path, cache=None, incremental=False, jobs=None, store=None, stats=None, **kwargs):
+    with phase(stats, "parse"):
+        root, transactions = load_path(path, cache=cache, incremental=incremental, jobs=jobs, stats=stats, **kwargs)
+    if store is not None:
+        store.extend(transactions)
     return root, transactions
 
 
+def load_path(path, cache=None, incremental=False, jobs=None, stats=None, plan=None, **kwargs):
+    if not os.path.isfile(path):
+        # a pipe can only be read once, so there is nothing to key a cache on or to split between jobs
+        cache = jobs = None
+    if cache:
+        # snapshots and checkpoints have to serve every query
+        plan = None
+    if cache and incremental:
+        return parse_incremental(path, cache, stats=stats, **kwargs)
+    if cache:
+        cache_path = get_cache_path(cache, path, ".snapshot")
+        key = get_file_key(path, **kwargs)
+        state = load_snapshot(cache_path, key)
+        if state and includes_unchanged(state[0]):
+            logging.debug("Loaded snapshot %s", cache_path)
+            state[0].stats = stats
+            return state
+    with open(path, "rb") as f:
+        parser = Parser(stats=stats, path=path, cache=cache, plan=plan, **kwargs)
+        if jobs and jobs > 1:
+            parse_parallel(parser, f, jobs)
+        else:
+            reader = LineReader(f)
+            parser.parse_numbered(reader)
+            if stats is not None:
+                stats.count("lines", reader.line_num)
+        state = parser.finish()
+    if cache:
+        save_snapshot(cache_path, key, state)
+    return state
+
+
 if __name__ == "__main__":
     logging.basicConfig(format='[%(filename)s:%(lineno)s]%(levelname)s:%(message)s', level=logging.INFO)
-    parse_args()
+    try:
+        parse_args()
+        # the parsed ledger lives until exit, so spare the collector's final pass over it; only a one-shot run can
+        # do this, as anything that goes on parsing would leak every ledger it freezes
+        gc.freeze()
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # the reader went away (e.g. `pledger reg | head`); keep the interpreter from complaining when it flushes stdout on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
@@ -1,6 +1,18 @@
 import unittest
 from decimal import Decimal
-from pledger import getCurrencySymbol, Account, Transaction, parse_file, parse_args
+import asyncio
+import contextlib
+import datetime
+import gc
+import io
+import json
+import os
+import pickle
+import tempfile
+import threading
+import unittest.mock
+from benchmark import generate_ledger
+from pledger import getCurrencySymbol, Account, AccountFilter, DateIndex, LedgerWatcher, MarketPrices, AutoTransaction, AutoTransactionIndex, LineReader, Parser, PeriodicScheduler, PostingStore, QueryDaemon, QueryPlan, Stats, Transaction, evaluate, get_cache_path, literal_prefix, date_key, parse_amount, parse_file, parse_args, parse_parallel, parse_path, report
 
 
 class CurrencyTest(unittest.TestCase):
@@ -9,6 +21,68 @@ class CurrencyTest(unittest.TestCase):
             with self.subTest(token=token):
                 self.assertEqual("$", getCurrencySymbol(token))
 
+    def test_parse_amount(self):
+        for token, expected in (("-$1,234.5", (("$", Decimal("-1234.5")), None, None)),
+                                ("10 STOCK @ $5", (("STOCK", 10), ("$", 5, False), None)),
+                                ("4 STOCK @@ $20", (("STOCK", 4), ("$", 20, True), None)),
+                                ("$10 =$110", (("$", 10), None, ("$", 110))),
+                                ("=$0", (None, None, ("$", 0))),
+                                ("(2 * $10)", (("$", 20), None, None))):
+            with self.subTest(token=token):
+                self.assertEqual(parse_amount(token), expected)
+
+    def test_evaluate(self):
+        for expr, expected in (("-(.12 / 12)", Decimal("-0.01")), ("1 + 2 * 3", 7), ("(1 + 2) * 3", 9), ("2 - -1", 3)):
+            with self.subTest(expr=expr):
+                self.assertEqual(evaluate(expr), expected)
+        for expr in ("__import__('os')", "(1 + 2", "1 +"):
+            with self.subTest(expr=expr):
+                self.assertRaises(ValueError, evaluate, expr)
+
+
+class AccountTest(unittest.TestCase):
+    def test_rolled_up_value(self):
+        root = Account()
+        root.getAccount("Assets:Bank:Checking").addValue("$", Decimal(10))
+        root.getAccount("Assets:Bank").addValue("$", Decimal(5))
+        root.getAccount("Assets:Cash").addValue("EUR", Decimal(1))
+        self.assertEqual(root.getAccount("Assets:Bank").getValue("$"), 15)
+        self.assertEqual(root.getAccount("Assets").getValue("$"), 15)
+        self.assertEqual(set(root.getCurrencies()), {"$", "EUR"})
+
+        root.getAccount("Assets:Bank:Checking").addValue("$", Decimal(2), init=True)
+        self.assertEqual(root.getAccount("Assets").getValue("$"), 7)
+        self.assertEqual(root.getAccount("Assets:Bank:Checking").getSpecificValue("$"), 2)
+
+    def test_account_index(self):
+        root = Account()
+        account = root.getAccount("Assets:Bank:Checking")
+        self.assertIs(account, root.accounts["Assets:Bank:Checking"])
+        self.assertIs(account, root.getAccount(":Assets:Bank:Checking"))
+        self.assertIs(account, root.getAccount("Assets").getAccount("Bank:Checking"))
+        self.assertEqual(account.getProperName(), "Assets:Bank:Checking")
+        self.assertEqual(account.getDepth(), 2)
+        self.assertIs(account.getAncestor(1), root.accounts["Assets"])
+
+    def test_filter(self):
+        root = Account()
+        accountFilter = AccountFilter(["Assets:B", "Exp"])
+        for name, expected in (("Assets:Bank", True), ("Assets", False), ("Expenses:Food", True), ("Income:Exp", False)):
+            with self.subTest(name=name):
+                self.assertEqual(root.getAccount(name).matches(accountFilter), expected)
+                self.assertEqual(root.getAccount(name).matchCache[accountFilter], expected)
+                self.assertEqual(bool(root.getAccount(name).matches(["Assets:B", "Exp"])), expected)
+        self.assertEqual(AccountFilter(["Assets:B", "Exp"]), accountFilter)
+        self.assertEqual(hash(AccountFilter(("Assets:B", "Exp"))), hash(accountFilter))
+
+        # each pattern keeps its own inline flags and group numbers
+        for patterns, name, expected in ((["(?i)assets"], "Assets:Bank", True), (["Exp", "(?i)income"], "Income:Job", True), (["Exp", r"(\w)\w*:\1"], "Income:Interest", True), (["Exp", r"(\w)\w*:\1"], "Income:Job", False)):
+            with self.subTest(patterns=patterns, name=name):
+                self.assertEqual(root.getAccount(name).matches(AccountFilter(patterns)), expected)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            parse_args(["bal", "(?i)assets"], ParserTest.lines)
+        self.assertIn("Assets", output.getvalue())
+
 
 class TransactionTest(unittest.TestCase):
     def setUp(self):
@@ -64,6 +138,18 @@ class TransactionTest(unittest.TestCase):
         self.assertEqual(self.root.getAccount("Assets").getValue("STOCK"), 10)
         self.assertEqual(self.root.getAccount("Assets").getValue("$"), -1000)
 
+    conversion_lines = """
+2000/01/01 Buy
+    Assets:Broker                             10 STOCK @ $100.25
+    Assets:Bank
+2000/01/02 Buy
+    Assets:Broker                             3 STOCK @@ $10
+    Assets:Bank
+2000/01/03 Check
+    Assets:Broker                             =$-1012.50
+    Assets:Bank                               $0
+""".splitlines()
+
     def test_conversion_total(self):
         t = Transaction("2000/01/01", "title", self.root)
         t.addItem("Assets", "10 STOCK @@ $100")
@@ -72,6 +158,17 @@ class TransactionTest(unittest.TestCase):
         self.assertEqual(self.root.getAccount("Assets").getValue("STOCK"), 10)
         self.assertEqual(self.root.getAccount("Assets").getValue("$"), -100)
 
+    def test_item_representation(self):
+        t = Transaction("2000/01/01", "title", self.root)
+        single = t.addItem("Assets", "$10")
+        converted = t.addItem("Assets", "10 STOCK @ $1")
+        self.assertIsNone(single.values)
+        self.assertEqual(single.getValues(), {"$": 10})
+        self.assertEqual(converted.getValues(), {"STOCK": 10, "$": -10})
+        self.assertTrue(converted.isNetZero())
+        self.assertFalse(single.isNetZero())
+        self.assertRaises(AttributeError, setattr, single, "extra", None)
+
     def dummyAdd(self, accountName, valueStr):
         t = Transaction("2000/01/01", "Test", self.root)
         t.addItem(accountName, valueStr)
@@ -161,6 +258,17 @@ class PeriodicTransactionTest(unittest.TestCase):
         root, transactions = parse_file(self.lines)
         self.assertEqual(int(root.getAccount("Assets:Credit").getValue("$")), -(366 * 1 + 12 * 100 + 1 * 1000))
 
+    def test_scheduler(self):
+        scheduler = PeriodicScheduler()
+        scheduler.add(datetime.date(2000, 2, 1), "monthly", 1)
+        scheduler.add(datetime.date(2000, 1, 2), "daily", 2)
+        scheduler.add(datetime.date(2001, 1, 1), "yearly", 0)
+        due = [(d.isoformat(), label) for d, label, _ in scheduler.due(datetime.date(2000, 1, 3))]
+        self.assertEqual(due, [("2000-01-02", "daily"), ("2000-01-03", "daily")])
+        scheduler.cancel("daily")
+        due = [(d.isoformat(), label) for d, label, _ in scheduler.due(datetime.date(2000, 3, 1))]
+        self.assertEqual(due, [("2000-02-01", "monthly"), ("2000-03-01", "monthly")])
+
 
 class AutoTransactionTest(unittest.TestCase):
     perecent_lines = """
@@ -193,6 +301,24 @@ class AutoTransactionTest(unittest.TestCase):
     def test_auto_transaction_abs(self):
         root, transactions = parse_file(self.abs_lines)
 
+    def test_literal_prefix(self):
+        for pattern, prefix in (("^Loan:Car$", "Loan:Car"), ("Assets:Credit", "Assets:Credit"), ("Assets:Cred?it", "Assets:Cre"),
+                                ("Assets.*", "Assets"), ("A|B", ""), ("(A)", "")):
+            with self.subTest(pattern=pattern):
+                self.assertEqual(literal_prefix(pattern), prefix)
+
+    def test_index(self):
+        root = Account()
+        index = AutoTransactionIndex()
+        rules = [AutoTransaction(pattern, root, label) for pattern, label in (("Assets:Credit", "A"), ("^.*Credit", "B"), ("Assets", "C"), ("Expenses:Food", "D"))]
+        for rule in rules:
+            index.add(rule)
+        self.assertEqual(index.match(root.getAccount("Assets:Credit:Card")), rules[:3])
+        self.assertEqual(index.match(root.getAccount("Expenses:Food")), [rules[3]])
+        self.assertIs(index.remove("B"), rules[1])
+        self.assertEqual(index.match(root.getAccount("Assets:Credit:Card")), [rules[0], rules[2]])
+        self.assertIsNone(index.remove("B"))
+
 
 class AutoPeriodicTransactionTest(unittest.TestCase):
     lines = """
@@ -277,6 +403,68 @@ class ParserTest(unittest.TestCase):
         assert(root.children)
         assert(transactions)
 
+    def test_posting_store(self):
+        store = PostingStore()
+        root, transactions = parse_file(self.lines, store=store)
+        self.assertEqual(len(store), sum(len(t.items) for t in transactions))
+        self.assertEqual(store.commodities, ["$"])
+        self.assertEqual(set(store.dates), {20000101, 20000102, 20000103})
+        credit = store.account_index[root.getAccount("Assets:Credit")]
+        total = sum(amount for account_id, amount in zip(store.account_ids, store.amounts) if account_id == credit)
+        self.assertEqual(store.toDecimal(total), root.getAccount("Assets:Credit").getValue("$"))
+
+    def test_report_store(self):
+        store = PostingStore()
+        root, transactions = parse_file(AutoPeriodicTransactionTest.lines_shorthand + self.lines, store=store)
+        for date_index in (0, 1, 2):
+            for accountFilter in (None, AccountFilter(["Assets", "Loan"])):
+                with self.subTest(date_index=date_index, accountFilter=accountFilter):
+                    outputs = []
+                    for kwargs in ({}, {"store": store}):
+                        with contextlib.redirect_stdout(io.StringIO()) as output:
+                            report(root, transactions, accountFilter, date_index=date_index, market=None, **kwargs)
+                        outputs.append(output.getvalue())
+                    self.assertEqual(outputs[0], outputs[1])
+                    self.assertTrue(outputs[0])
+
+    def test_report_store_large(self):
+        # each amount fits in int64 once scaled, but not the sum of two
+        lines = ["2000/01/01 Big", "    Assets:Bank   $50000000000.12", "    Equity", "2000/01/02 Bigger", "    Assets:Bank   $100000000000.01", "    Equity"]
+        store = PostingStore()
+        root, transactions = parse_file(lines, store=store)
+        self.assertFalse(store.fitsInt64())
+        self.assertIsInstance(store.amounts, list)
+        outputs = []
+        for kwargs in ({}, {"store": store}):
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                report(root, transactions, AccountFilter(["Assets"]), date_index=0, market=None, **kwargs)
+            outputs.append(output.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn("150000000000.13", outputs[0])
+        self.assertTrue(PostingStore().extend(parse_file(self.lines)[1]).fitsInt64())
+
+    def test_date_index(self):
+        root, transactions = parse_file(self.lines)
+        index = DateIndex(transactions[::-1])
+        self.assertEqual(date_key("2021"), 20210000)
+        self.assertEqual([t.date for t in index.range("2000/01/02")], ["2000/01/02", "2000/01/03"])
+        self.assertEqual([t.date for t in index.range("2000/01/02", "2000/01/02")], ["2000/01/02"])
+        self.assertEqual([t.date for t in index.range(end="2000/01/01")], ["2000/01/01", "2000/01/01"])
+        self.assertEqual(index.range("2001"), [])
+
+    def test_start_end(self):
+        store = PostingStore()
+        root, transactions = parse_file(self.lines, store=store)
+        for start, end in (("2000/01/02", None), (None, "2000/01/02"), ("2000/01/02", "2000/01/02")):
+            with self.subTest(start=start, end=end):
+                with contextlib.redirect_stdout(io.StringIO()) as output:
+                    parse_args(["--start", start or "0", "--end", end or "9999", "report", "-d"], self.lines)
+                with contextlib.redirect_stdout(io.StringIO()) as store_output:
+                    report(root, transactions, date_index=2, market=None, store=store, start=start, end=end)
+                self.assertEqual(output.getvalue(), store_output.getvalue())
+                self.assertNotIn("2000/01/01", output.getvalue() if start else "")
+                self.assertNotIn("2000/01/03", output.getvalue() if end else "")
+
     def test_parse_file_empty(self):
         root, transactions = parse_file([])
 
@@ -285,6 +473,255 @@ class ParserTest(unittest.TestCase):
         self.assertRaises(Exception, parse_file, lines)
         parse_file(self.lines, end="2021")
 
+    def test_line_reader(self):
+        with tempfile.TemporaryFile() as f:
+            f.write("\n".join(self.lines).encode())
+            f.flush()
+            f.seek(0)
+            lines = list(LineReader(f))
+            self.assertEqual([line_num for line_num, _ in lines], [i + 1 for i, line in enumerate(self.lines) if line.strip() and line[0] not in ";%|*"])
+            self.assertEqual([line.rstrip("\n") for _, line in lines], [self.lines[line_num - 1] for line_num, _ in lines])
+
+    def test_parse_pipe(self):
+        expected_root, expected_transactions = parse_file(self.lines)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "fifo")
+            os.mkfifo(path)
+            for kwargs in ({}, {"cache": tmp, "jobs": 2}):
+                with self.subTest(kwargs=kwargs):
+                    writer = threading.Thread(target=lambda: open(path, "w").write("\n".join(self.lines)))
+                    writer.start()
+                    root, transactions = parse_path(path, **kwargs)
+                    writer.join()
+                    self.assertEqual([t.getHeader() for t in transactions], [t.getHeader() for t in expected_transactions])
+                    self.assertEqual(root.getAccount("Assets:Credit").getValue("$"), expected_root.getAccount("Assets:Credit").getValue("$"))
+            self.assertEqual(os.listdir(tmp), ["fifo"])
+
+    def test_parse_parallel(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write("\n".join(AutoPeriodicTransactionTest.lines_shorthand + self.lines).encode())
+            f.flush()
+            root, transactions = parse_file(AutoPeriodicTransactionTest.lines_shorthand + self.lines)
+            parallel_root, parallel_transactions = parse_parallel(Parser(), f, 2, chunk_size=64).finish()
+            self.assertEqual([(t.line_num, t.date, t.title) for t in parallel_transactions], [(t.line_num, t.date, t.title) for t in transactions])
+            for name, account in root.accounts.items():
+                with self.subTest(name=name):
+                    self.assertEqual(parallel_root.getAccount(name).getValue("$"), account.getValue("$"))
+
+        # lines a worker can't make sense of are reported by the parser, with their line number
+        with tempfile.NamedTemporaryFile() as f:
+            f.write("\n".join(self.lines + ["2000/01/04 Bad", "    Expenses:Food   $(1 +", "    Assets:Credit"]).encode())
+            f.flush()
+            with self.assertLogs(level="ERROR") as logs:
+                self.assertRaises(ValueError, parse_parallel, Parser(path=f.name), f, 2, chunk_size=64)
+            self.assertIn(f"{f.name}:{len(self.lines) + 2}", logs.output[0])
+
+    def test_parse_path_cache(self):
+        with tempfile.TemporaryDirectory() as cache:
+            path = os.path.join(cache, "ledger")
+            with open(path, "w") as f:
+                f.write("\n".join(self.lines))
+            root, transactions = parse_path(path, cache=cache)
+            self.assertTrue(os.listdir(cache))
+            # a daemon reloads snapshots, so they must stay collectable
+            frozen = gc.get_freeze_count()
+            cached_root, cached_transactions = parse_path(path, cache=cache)
+            self.assertEqual(gc.get_freeze_count(), frozen)
+            self.assertEqual(cached_root.getAccount("Assets:Credit").getValue("$"), root.getAccount("Assets:Credit").getValue("$"))
+            self.assertEqual(len(cached_transactions), len(transactions))
+
+            with open(path, "a") as f:
+                f.write("\n2000/01/04 Transaction 4\n    Expenses:Food   $1\n    Assets:Credit\n")
+            root, transactions = parse_path(path, cache=cache)
+            self.assertEqual(root.getAccount("Assets:Credit").getValue("$"), -601)
+
+    def test_parse_path_incremental(self):
+        with tempfile.TemporaryDirectory() as cache:
+            path = os.path.join(cache, "ledger")
+            with open(path, "w") as f:
+                f.write("\n".join(self.lines[:-3]) + "\n")
+            root, transactions = parse_path(path, cache=cache, incremental=True)
+            self.assertEqual(root.getAccount("Assets:Credit").getValue("$"), -300)
+
+            with open(path, "a") as f:
+                f.write("\n".join(self.lines[-3:-1]) + "\n2000/01/04 Transaction 4\n    Expenses:Food   $1\n    Assets:Credit\n")
+            frozen = gc.get_freeze_count()
+            root, transactions = parse_path(path, cache=cache, incremental=True)
+            self.assertEqual(gc.get_freeze_count(), frozen)
+            self.assertEqual(root.getAccount("Assets:Credit").getValue("$"), -601)
+            self.assertEqual(transactions[-1].line_num, len(self.lines))
+
+            with open(path, "w") as f:
+                f.write("\n".join(self.lines[:8]) + "\n")
+            root, transactions = parse_path(path, cache=cache, incremental=True)
+            self.assertEqual(root.getAccount("Assets:Credit").getValue("$"), -150)
+
+    def test_watcher(self):
+        def totals(state):
+            root, transactions = state
+            return [t.getHeader() for t in transactions], {a.getProperName(): dict(a.totals) for a in root.accounts.values()}
+
+        lines = AutoPeriodicTransactionTest.lines_shorthand + self.lines
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ledger")
+
+            def write(lines, mode="w"):
+                with open(path, mode) as f:
+                    f.write("\n".join(lines) + "\n")
+
+            write(lines[:-4])
+            watcher = LedgerWatcher(path)
+            parser = watcher.parser
+            self.assertEqual(totals(watcher.getState()), totals(parse_file(lines[:-4])))
+            # the first parse leaves evenly spaced states behind for the first edit
+            self.assertEqual(len(watcher.checkpoints), watcher.max_checkpoints - 1)
+            self.assertEqual(sorted(watcher.checkpoints), watcher.checkpoints)
+
+            write(lines[-4:], "a")
+            self.assertTrue(watcher.changed())
+            watcher.update()
+            self.assertIs(watcher.parser, parser)
+            self.assertEqual(totals(watcher.getState()), totals(parse_file(lines)))
+
+            for old, new in (("$300; Comment", "$300"), ("-$100", "-$200"), ("Transaction 1", "Groceries")):
+                with self.subTest(old=old):
+                    lines = [line.replace(old, new) for line in lines]
+                    write(lines)
+                    with self.assertLogs(level="DEBUG") as logs:
+                        watcher.update()
+                    if old == "$300; Comment":
+                        self.assertNotIn("from line 0", logs.output[0])
+                    self.assertEqual(totals(watcher.getState()), totals(parse_file(lines)))
+            self.assertTrue(watcher.checkpoints)
+
+            write(lines + ["2001/01/01 Broken", "    Expenses:Food  $1", "    Assets:Credit  $1"])
+            self.assertRaises(ValueError, watcher.update)
+            self.assertIsNone(watcher.parser)
+            write(lines)
+            watcher.update()
+            self.assertEqual(totals(watcher.getState()), totals(parse_file(lines)))
+
+    def test_watcher_append_directive(self):
+        # the last entry was already committed by finish(); an appended I line must not commit it again
+        for last in (["    Expenses:Food    $5", "    Assets:Bank"], ["    Expenses:Food    $5", "    Assets:Bank    -$5"]):
+            lines = ["2000/01/01 Loan", "    Loan:Car    -$1000", "    Assets:Bank    $1000", "2000/01/02 Food", *last]
+            appended = ["I Loan:Car ~monthly -(.12 / 12) Interest :Interest", "2000/03/01 Food", "    Expenses:Food    $1", "    Assets:Bank"]
+            with self.subTest(last=last), tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "ledger")
+                with open(path, "w") as f:
+                    f.write("\n".join(lines) + "\n")
+                watcher = LedgerWatcher(path)
+                parser = watcher.parser
+                with open(path, "a") as f:
+                    f.write("\n".join(appended) + "\n")
+                watcher.update()
+                self.assertIs(watcher.parser, parser)
+                root, transactions = watcher.getState()
+                expected_root, expected_transactions = parse_file(lines + appended)
+                self.assertEqual([t.getHeader() for t in transactions], [t.getHeader() for t in expected_transactions])
+                self.assertEqual({a.getProperName(): dict(a.totals) for a in root.accounts.values()}, {a.getProperName(): dict(a.totals) for a in expected_root.accounts.values()})
+                self.assertEqual(root.getAccount("Expenses:Food").getValue("$"), 6)
+
+    def test_generated_ledger(self):
+        lines = generate_ledger(200, depth=4, fan_out=2, commodities=3)
+        self.assertEqual(lines, generate_ledger(200, depth=4, fan_out=2, commodities=3))
+        for prefix in ("=", "~", "I "):
+            self.assertTrue(any(line.startswith(prefix) for line in lines))
+        root, transactions = parse_file(lines)
+        self.assertEqual(root.getAccount("Assets:Checked").getValue("$"), Decimal(lines[-3].split("=$")[-1]))
+        self.assertTrue(root.getAccount("Expenses:C1:C1:C1").getValue("$"))
+        self.assertEqual(set(root.getAccount("Assets:Broker").getCurrencies()), {"$", "STKA", "STKB", "STKC"})
+
+    def test_profile(self):
+        stats = Stats()
+        root, transactions = parse_file(AutoPeriodicTransactionTest.lines, stats=stats)
+        counters = stats.toDict()["counters"]
+        self.assertEqual(counters["commits"], len(transactions))
+        self.assertEqual(counters["periodic_occurrences"], 1)
+        self.assertEqual(counters["auto_hits"], 1)
+        self.assertEqual(counters["postings"], sum(len(t.items) for t in transactions) - counters["auto_hits"] * 2)
+        calls = stats.counters["getValue"]
+        root.getAccount("Loan").getValue("$")
+        self.assertEqual(stats.counters["getValue"], calls + 1)
+        self.assertIn("parse", stats.phases)
+        self.assertIsNone(pickle.loads(pickle.dumps(root)).stats)
+
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()) as err:
+            stats = parse_args(["--profile", "bal"], self.lines)
+        self.assertEqual(json.loads(err.getvalue()), stats.toDict())
+        self.assertTrue({"parse", "commit", "render"} <= stats.phases.keys())
+        self.assertTrue(stats.counters["getValue"])
+
+        # every line is counted once, comments and blanks included, whichever way it was read
+        lines = ["; comment", ""] + self.lines
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ledger")
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            for kwargs in ({}, {"jobs": 2}, {"cache": tmp, "incremental": True}):
+                with self.subTest(**kwargs):
+                    stats = Stats()
+                    parse_path(path, stats=stats, **kwargs)
+                    self.assertEqual(stats.counters["lines"], len(lines))
+                    self.assertEqual(stats.counters["parsed_lines"], sum(1 for line in lines if line.strip() and line[0] not in ";%|*"))
+
+    def test_include(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, "years"))
+            files = {"main": ["= ^Expenses", "    Assets:Rewards    .1", "    Income:Rewards    -.1", "include years/*.ledger", "2002/01/01 Main", "    Expenses:Food    $1", "    Assets:Bank"],
+                     "years/2000.ledger": self.lines[:12],
+                     "years/2001.ledger": ["2001/01/01 Later", "    Expenses:Food    $5", "    Assets:Bank"]}
+
+            def write(name):
+                with open(os.path.join(tmp, name), "w") as f:
+                    f.write("\n".join(files[name]) + "\n")
+
+            def check(root, **kwargs):
+                expected, _ = parse_file(files["main"][:3] + files["years/2000.ledger"] + files["years/2001.ledger"] + files["main"][4:], **kwargs)
+                self.assertEqual({a.getProperName(): dict(a.totals) for a in root.accounts.values()}, {a.getProperName(): dict(a.totals) for a in expected.accounts.values()})
+            for name in files:
+                write(name)
+            main = os.path.join(tmp, "main")
+
+            root, transactions = parse_path(main)
+            check(root)
+            # nothing is hashed without a cache to check the keys against
+            self.assertEqual(set(root.includes.values()), {None})
+
+            # --end inside an included file stops the rest of the glob and the including file too
+            root, transactions = parse_path(main, end="2000/01/01")
+            check(root, end="2000/01/01")
+            self.assertEqual([t.date for t in transactions], ["2000/01/01", "2000/01/01"])
+            cache = os.path.join(tmp, "cache")
+            for incremental in (False, True, False, True):
+                check(parse_path(main, cache=cache, incremental=incremental)[0])
+            tokens = {name: os.stat(get_cache_path(cache, os.path.join(tmp, name), ".tokens")).st_mtime_ns for name in files if name != "main"}
+
+            files["years/2001.ledger"][1] = "    Expenses:Food    $7"
+            write("years/2001.ledger")
+            for incremental in (False, True):
+                check(parse_path(main, cache=cache, incremental=incremental)[0])
+            self.assertEqual(os.stat(get_cache_path(cache, os.path.join(tmp, "years/2000.ledger"), ".tokens")).st_mtime_ns, tokens["years/2000.ledger"])
+            self.assertNotEqual(os.stat(get_cache_path(cache, os.path.join(tmp, "years/2001.ledger"), ".tokens")).st_mtime_ns, tokens["years/2001.ledger"])
+
+            files["years/2001.ledger"][1] = "    Expenses:Food    $7 =$9"
+            write("years/2001.ledger")
+            with self.assertLogs(level="ERROR") as logs, self.assertRaises(ValueError):
+                parse_path(main)
+            self.assertIn("2001.ledger:1", logs.output[0])
+
+            files["years/2001.ledger"] = ["include ../main"]
+            write("years/2001.ledger")
+            with self.assertLogs(level="ERROR"), self.assertRaises(ValueError):
+                parse_path(main)
+
+    def test_parse_args_no_freeze(self):
+        # parse_args is also the programmatic entry point, so it must leave everything collectable
+        frozen = gc.get_freeze_count()
+        with contextlib.redirect_stdout(io.StringIO()):
+            parse_args(["bal"], self.lines)
+        self.assertEqual(gc.get_freeze_count(), frozen)
+
     def test_subcommands(self):
         for cmd in ["balance", "register", "report"]:
             with self.subTest(cmd=cmd):
@@ -295,6 +732,268 @@ class ParserTest(unittest.TestCase):
                 parse_args([cmd, "Assets", "Expenses"], self.lines)
                 parse_args([cmd, "A", "E"], self.lines)
 
+    def test_register_limit_tail(self):
+        def run(*args):
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                parse_args(["register", *args], self.lines)
+            return out.getvalue().splitlines()
+        rows = run()
+        self.assertTrue(len(rows) > 2)
+        self.assertEqual(run("--limit", "2"), rows[:2])
+        self.assertEqual(run("--tail", "2"), rows[-2:])
+        self.assertEqual(run("--limit", "0"), [])
+
+    def test_query_plan(self):
+        def run(lines, *args):
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                parse_args(list(args), lines)
+            return out.getvalue()
+
+        for lines in (generate_ledger(300, assertion_every=0, interest_rules=0), generate_ledger(300)):
+            for args in (["bal"], ["bal", "Expenses"], ["reg", "Expenses:C1"], ["reg", "-d", "2", "Expenses"], ["--start", "2000/01/15", "reg", "Assets"],
+                         ["rep", "Income"], ["--market", "rep"], ["--start", "2000/01/15", "rep", "-d", "Expenses"]):
+                with self.subTest(args=args, assertions=len(lines)):
+                    expected = run(lines, *args)
+                    with unittest.mock.patch("pledger.plan_query", return_value=None):
+                        self.assertEqual(run(lines, *args), expected)
+                    self.assertTrue(expected)
+
+        lines = generate_ledger(300, assertion_every=0, interest_rules=0)
+        full_root, full_transactions = parse_file(lines)
+        root, transactions = parse_file(lines, plan=QueryPlan(retain=False))
+        self.assertEqual(transactions, [])
+        self.assertEqual(root.getAccount("Assets:Bank").getValue("$"), full_root.getAccount("Assets:Bank").getValue("$"))
+
+        # the tree stays complete, so balance assertions still check out
+        lines = generate_ledger(300)
+        full_root, full_transactions = parse_file(lines)
+        root, transactions = parse_file(lines, plan=QueryPlan(startKey=20000115, accountFilter=AccountFilter(["Expenses:C1"])))
+        self.assertTrue(0 < len(transactions) < len(full_transactions))
+        self.assertTrue(all(t.dateKey >= 20000115 for t in transactions))
+        self.assertTrue(all(any(item.account.matches(AccountFilter(["Expenses:C1"])) for item in t.items) for t in transactions))
+        self.assertEqual(root.getAccount("Assets:Bank").getValue("$"), full_root.getAccount("Assets:Bank").getValue("$"))
+
+    def test_register_running_balance(self):
+        lines = """
+2000/01/01 A
+    Assets:Bank:Checking    $10
+    Assets:Bank:Savings     $5
+    Equity
+2000/01/02 B
+    Expenses:Food           $3
+    Assets:Bank:Checking
+""".splitlines()
+        for args, expected in ((["-d", "2", "Assets:Bank:Checking"], [("Assets:Bank", "10.00"), ("Assets:Bank", "12.00")]),
+                               (["Assets:Bank"], [("Assets:Bank:Checking", "10.00"), ("Assets:Bank:Savings", "5.00"), ("Assets:Bank:Checking", "7.00")]),
+                               (["-d", "1", "Assets", "Expenses"], [("Assets", "10.00"), ("Assets", "15.00"), ("Expenses", "3.00"), ("Assets", "12.00")])):
+            with self.subTest(args=args):
+                with contextlib.redirect_stdout(io.StringIO()) as out:
+                    parse_args(["register", *args], lines)
+                rows = [row.split("\t") for row in out.getvalue().splitlines()]
+                self.assertEqual([(row[1].strip(), row[3].split()[-1]) for row in rows], expected)
+
+
+class QueryDaemonTest(unittest.TestCase):
+    lines = ParserTest.lines
+
+    def test_daemon(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ledger")
+            socket_path = os.path.join(tmp, "socket")
+            with open(path, "w") as f:
+                f.write("\n".join(self.lines))
+
+            daemon = QueryDaemon()
+            loop = asyncio.new_event_loop()
+            server = loop.run_until_complete(asyncio.start_unix_server(daemon.handle, socket_path))
+            os.chmod(socket_path, 0o600)
+            thread = threading.Thread(target=loop.run_forever)
+            thread.start()
+            try:
+                for cmd in (["bal"], ["reg", "Assets"], ["rep", "-m"]):
+                    with self.subTest(cmd=cmd):
+                        with contextlib.redirect_stdout(io.StringIO()) as local:
+                            parse_args(cmd, self.lines)
+                        with contextlib.redirect_stdout(io.StringIO()) as remote:
+                            parse_args(["-f", path, "--socket", socket_path, *cmd])
+                        self.assertEqual(remote.getvalue(), local.getvalue())
+                        self.assertEqual(len(daemon.states), 1)
+                # the report went through a store built for the parsed state
+                self.assertIsInstance(next(iter(daemon.states.values()))[2], PostingStore)
+
+                with open(path, "a") as f:
+                    f.write("\n2000/01/04 Transaction 4\n    Expenses:Food   $1\n    Assets:Credit\n")
+                with contextlib.redirect_stdout(io.StringIO()) as remote:
+                    parse_args(["-f", path, "--socket", socket_path, "bal"])
+                self.assertIn("-601", remote.getvalue())
+                self.assertIsNone(next(iter(daemon.states.values()))[2])
+
+                with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+                    parse_args(["-f", path, "--socket", socket_path, "bal", "--bogus"])
+
+                # a socket others could have planted or can connect to is not trusted
+                os.chmod(socket_path, 0o666)
+                with contextlib.redirect_stdout(io.StringIO()) as remote, self.assertLogs(level="WARNING"):
+                    parse_args(["-f", path, "--socket", socket_path, "reg"])
+                self.assertIn("Transaction 4", remote.getvalue())
+                self.assertNotIn(("reg",), [key[0] for key in daemon.results])
+                with contextlib.redirect_stdout(io.StringIO()) as remote, self.assertLogs(level="WARNING"):
+                    parse_args(["-f", path, "--socket", path, "bal"])
+                self.assertIn("-601", remote.getvalue())
+            finally:
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join()
+                server.close()
+                loop.run_until_complete(server.wait_closed())
+                loop.close()
+
+        self.assertFalse(parse_args(["--socket", socket_path, "bal"], self.lines))
+
+    def test_concurrent_queries(self):
+        started, release = threading.Event(), threading.Event()
+        loads = []
+
+        class SlowDaemon(QueryDaemon):
+            def load(self, namespace):
+                loads.append(namespace.file)
+                if namespace.file.endswith("slow"):
+                    started.set()
+                    release.wait(5)
+                return super().load(namespace)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fast, slow = os.path.join(tmp, "fast"), os.path.join(tmp, "slow")
+            for path in (fast, slow):
+                with open(path, "w") as f:
+                    f.write("\n".join(self.lines))
+            daemon = SlowDaemon()
+
+            async def run():
+                expected = await daemon.query(["bal"], file=fast)
+                pending = [asyncio.ensure_future(daemon.query(["bal"], file=slow)) for _ in range(2)]
+                await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+                # a parse in flight holds up neither other ledgers nor results already computed
+                self.assertEqual(await asyncio.wait_for(daemon.query(["bal"], file=fast), 5), expected)
+                self.assertEqual((await asyncio.wait_for(daemon.query(["reg"], file=fast), 5))["status"], 0)
+                self.assertFalse(any(future.done() for future in pending))
+                release.set()
+                return expected, await asyncio.gather(*pending)
+
+            loop = asyncio.new_event_loop()
+            try:
+                expected, results = loop.run_until_complete(run())
+            finally:
+                release.set()
+                loop.close()
+            self.assertEqual(results, [expected, expected])
+            # both stale queries waited on the same parse
+            self.assertEqual(loads, [fast, slow])
+
+
+class MarketPriceTest(unittest.TestCase):
+    lines = """
+2000/01/01 Buy
+    Assets:Broker                             10 STOCK @ $10
+    Assets:Bank
+P 2000/02/15 STOCK $20
+2000/02/01 Buy
+    Assets:Broker                             10 STOCK @ $15
+    Assets:Bank
+P 2000/03/15 STOCK $30
+""".splitlines()
+
+    def test_prices(self):
+        prices = MarketPrices()
+        prices.add("STOCK", "$", 2, 20000201)
+        prices.add("STOCK", "$", 1, 20000101)
+        prices.add("STOCK", "$", 3, 20000301)
+        self.assertEqual(prices.get("STOCK", "$"), 3)
+        self.assertEqual(prices.get("STOCK", "$", 20000215), 2)
+        self.assertEqual(prices.get("STOCK", "$", 19990101), 1)
+        self.assertRaises(KeyError, prices.get, "STOCK", "EUR")
+
+        prices.load(["P 2000/02/20 STOCK $4", "; comment", "P 1999/12/01 STOCK $0.5"])
+        self.assertEqual(prices.get("STOCK", "$", 20000220), 4)
+        self.assertEqual(prices.get("STOCK", "$", 19991231), Decimal("0.5"))
+
+    def test_transitive_rate(self):
+        prices = MarketPrices()
+        prices.add("STOCK", "EUR", Decimal(10))
+        prices.add("EUR", "$", Decimal("1.5"))
+        prices.add("GBP", "EUR", Decimal("1.25"))
+        self.assertEqual(prices.getRate("STOCK", "$"), 15)
+        self.assertEqual(prices.getRate("$", "STOCK"), 1 / Decimal(15))
+        self.assertEqual(prices.getRate("GBP", "STOCK"), Decimal("0.125"))
+        self.assertIn(("STOCK", "$", None), prices.rates)
+        prices.add("STOCK", "$", Decimal(16))
+        self.assertFalse(prices.rates)
+        self.assertEqual(prices.getRate("STOCK", "$"), 16)
+        self.assertRaises(KeyError, prices.getRate, "STOCK", "YEN")
+
+    def test_exchange(self):
+        lines = self.lines + ["P 2000/03/15 $ 0.5EUR"]
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            parse_args(["-X", "EUR", "balance", "Assets"], lines)
+        self.assertEqual(output.getvalue().splitlines()[-1].split(), ["175.00", "EUR"])
+
+    def test_report_market(self):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            parse_args(["--market", "report", "Assets:Broker"], self.lines)
+        # each purchase posts both the stock and its cost, so a period's value is the gain over its own prices
+        self.assertEqual(output.getvalue().splitlines(), ["2000/01,         0.00", "2000/02,        50.00"])
+
+        root, _ = parse_file(self.lines)
+        self.assertEqual(root.getMarketPrice("STOCK", "$"), 30)
+        self.assertEqual(root.getMarketPrice("STOCK", "$", 20000201), 15)
+
+
+class FixedPointTest(unittest.TestCase):
+    ledgers = [PeriodicTransactionTest.lines, AutoTransactionTest.perecent_lines, AutoTransactionTest.abs_lines, AutoPeriodicTransactionTest.lines,
+               AutoPeriodicTransactionTest.lines_shorthand, AutoPeriodicTransactionTest.lines_shorthand_close, ParserTest.lines,
+               TransactionTest.conversion_lines, generate_ledger(3000)]
+
+    def test_same_balances(self):
+        for i, lines in enumerate(self.ledgers):
+            root, _ = parse_file(lines)
+            fixed_root, _ = parse_file(lines, precision={})
+            for name, account in root.accounts.items():
+                for c in account.getCurrencies():
+                    with self.subTest(ledger=i, name=name, c=c):
+                        fixed_account = fixed_root.getAccount(name)
+                        self.assertIsInstance(fixed_account.getValue(c), int if c else Decimal)
+                        expected, actual = account.getValue(c), fixed_root.numeric.toDecimal(c, fixed_account.getValue(c))
+                        if c:
+                            # repeated interest doesn't terminate, so only the places fixed point keeps can agree
+                            places = fixed_root.numeric.precision[c] - 2
+                            expected, actual = round(expected, places), round(actual, places)
+                        self.assertEqual(actual, expected)
+
+    def test_same_output(self):
+        for i, lines in enumerate(self.ledgers):
+            for cmd in ["balance", "register", "report"]:
+                with self.subTest(ledger=i, cmd=cmd):
+                    outputs = []
+                    for flags in ([], ["--fixed-point"]):
+                        with contextlib.redirect_stdout(io.StringIO()) as output:
+                            parse_args(flags + [cmd], lines)
+                        outputs.append(output.getvalue())
+                    self.assertEqual(outputs[0], outputs[1])
+
+    def test_precision(self):
+        lines = ["2000/01/01 Test", "    Assets  $1", "    Expenses", "2000/01/02 Test", "    Assets  $1.005", "    Expenses"]
+        root, _ = parse_file(lines, precision={"$": 3})
+        self.assertEqual(root.getAccount("Assets").getValue("$"), 2005)
+        self.assertRaises(ValueError, parse_file, lines, precision={"$": 2})
+
+        # a finer amount than any before it rescales what was already parsed
+        lines += ["= ^Expenses", "    Assets:Rewards  .01", "    Income:Rewards  -.01", "2000/01/03 Test", "    Expenses  $0.000000015 =$-2.004999985", "    Assets"]
+        decimal_root, _ = parse_file(lines)
+        root, _ = parse_file(lines, precision={})
+        self.assertEqual(root.numeric.precision["$"], 15)
+        for name in ("Assets", "Expenses", "Assets:Rewards"):
+            with self.subTest(name=name):
+                self.assertEqual(root.numeric.toDecimal("$", root.getAccount(name).getValue("$")), decimal_root.getAccount(name).getValue("$"))
+
 
 if __name__ == '__main__':
 